@@ -0,0 +1,95 @@
+"""
+Compare interaction log formats: size, write throughput and scan speed.
+
+Records are chat_history.json interactions repeated (with shifted player ids
+and timestamps) up to --records. Formats whose optional dependency is not
+installed are skipped.
+
+Usage: python benchmarks/bench_logs.py [--records 50000] [--source chat_history.json]
+"""
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import npc_logs
+from npc_ingest import format_timestamp, timestamp_key
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORMATS = [
+    ("jsonl", "log.jsonl", None),
+    ("gzip", "log.jsonl.gz", None),
+    ("zstd", "log.jsonl.zst", "zstandard"),
+    ("npz", "log.npz", "np"),
+    ("parquet", "log.parquet", "pa"),
+]
+
+
+def make_records(source: str, count: int):
+    base = list(npc_logs.load_records(source))
+    players = max(record['player_id'] for record in base) + 1
+    span = max(timestamp_key(r['timestamp']) for r in base) - min(timestamp_key(r['timestamp']) for r in base) + 1
+    records = []
+    for i in range(count):
+        copy, record = divmod(i, len(base))
+        record = dict(base[record])
+        record['player_id'] += copy * players
+        record['timestamp'] = format_timestamp(timestamp_key(record['timestamp']) + copy * span)
+        records.append(record)
+    return records
+
+
+def mood_counts(path: str, fmt: str):
+    """The kind of query analytics runs: one column over every record"""
+    if fmt in ("npz", "parquet"):
+        codes, moods = npc_logs.load_columns(path, ['npc_mood'])['npc_mood']
+        counts = npc_logs.np.bincount(codes, minlength=len(moods))
+        return dict(zip(moods.tolist(), counts.tolist()))
+    return dict(collections.Counter(record['npc_mood'] for record in npc_logs.read_log(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--source", default=os.path.join(ROOT, "chat_history.json"))
+    args = parser.parse_args()
+
+    records = make_records(args.source, args.records)
+    print(f"Records: {len(records)} (from {os.path.basename(args.source)})")
+    print(f"{'format':<8} {'size':>12} {'ratio':>7} {'write rec/s':>12} {'read rec/s':>11} {'mood scan ms':>13}")
+
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt, name, dependency in FORMATS:
+            if dependency and getattr(npc_logs, dependency) is None:
+                print(f"{fmt:<8} skipped ({dependency} not installed)")
+                continue
+            path = os.path.join(tmp, name)
+
+            started = time.perf_counter()
+            with npc_logs.create_log_writer(path, fmt) as writer:
+                for record in records:
+                    writer.write(record)
+            write_seconds = time.perf_counter() - started
+            size = os.path.getsize(path)
+            baseline = baseline or size
+
+            started = time.perf_counter()
+            read = sum(1 for _ in npc_logs.read_log(path))
+            read_seconds = time.perf_counter() - started
+            assert read == len(records)
+
+            started = time.perf_counter()
+            mood_counts(path, fmt)
+            scan_seconds = time.perf_counter() - started
+
+            print(f"{fmt:<8} {size:>12,} {baseline / size:>6.1f}x {len(records) / write_seconds:>12,.0f} "
+                  f"{len(records) / read_seconds:>11,.0f} {scan_seconds * 1000:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
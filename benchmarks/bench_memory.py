@@ -0,0 +1,82 @@
+"""
+Measure per-player construction cost and memory of the two memory modes.
+
+Creates --players players in EnhancedNPCSystem with the LangChain
+ConversationChain memory and with the native ring-buffer memory, records
+--turns turns for each directly in memory (no LLM calls, the fake backend,
+so no key or network) and reports the time to create a player and the
+traced Python memory per player.
+
+Usage: python benchmarks/bench_memory.py [--players 20000] [--turns 3]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_core.messages import AIMessage, HumanMessage
+from npc_backend import LLMBackend
+from npc_chat import EnhancedNPCSystem
+from npc_memory import NativeConversationMemory
+
+PLAYER_LINES = ["Hello there!", "Where can I find the blacksmith?", "Any quests for me today?",
+                "Thanks for your help.", "What news from the other towns?"]
+NPC_LINES = ["Well met, traveler.", "Past the well, follow the smoke.", "The mill has rats again.",
+             "Safe travels, adventurer.", "Bandits on the east road, they say."]
+
+
+def measure(mode: str, players: int, turns: int):
+    system = EnhancedNPCSystem("sk-bench", backend=LLMBackend("fake"), summary_mode="inline", memory_mode=mode)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    for player_id in range(players):
+        system._ensure_player(player_id)
+    create_seconds = time.perf_counter() - started
+
+    for player_id, conversation in system.player_conversations.items():
+        for turn in range(turns):
+            # Player text varies per player so the pool can't share all of it
+            player_text = f"{PLAYER_LINES[turn % len(PLAYER_LINES)]} ({player_id})"
+            npc_text = NPC_LINES[(player_id + turn) % len(NPC_LINES)]
+            if isinstance(conversation, NativeConversationMemory):
+                conversation.add_turn(player_text, npc_text)
+            else:
+                conversation.memory.chat_memory.add_messages([HumanMessage(content=player_text),
+                                                               AIMessage(content=npc_text)])
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    system.close()
+    return create_seconds / players, used / players
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--turns", type=int, default=3)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")  # LangChain deprecation warnings on every chain
+
+    print(f"Players: {args.players}, turns each: {args.turns}")
+    results = {}
+    for mode in ("langchain", "native"):
+        create, memory = measure(mode, args.players, args.turns)
+        results[mode] = (create, memory)
+        print(f"{mode:<10} create {create * 1e6:8.1f} us/player   memory {memory / 1024:6.2f} KiB/player   "
+              f"-> 100k players ~{memory * 100000 / 2 ** 20:,.0f} MiB")
+
+    (lc_create, lc_memory), (nat_create, nat_memory) = results['langchain'], results['native']
+    print(f"native vs langchain: {lc_create / nat_create:.0f}x faster to create, "
+          f"{lc_memory / nat_memory:.1f}x less memory")
+
+
+if __name__ == "__main__":
+    main()
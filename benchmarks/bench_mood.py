@@ -0,0 +1,87 @@
+"""
+Benchmark the compiled MoodClassifier against the original substring scan.
+
+Usage: python benchmarks/bench_mood.py [--triggers 10000] [--messages 2000]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from npc_mood import MoodClassifier, MoodRule
+
+MOODS = ["angry", "helpful", "friendly", "confused"]
+
+
+def make_vocabulary(size: int, rng: random.Random):
+    """Random lowercase words split evenly across the moods"""
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return {mood: words[i::len(MOODS)] for i, mood in enumerate(MOODS)}
+
+
+def make_messages(count: int, vocabulary, rng: random.Random, trigger_rate: float = 0.3):
+    filler = "the a to of and you i where is my sword village inn quest today".split()
+    all_triggers = [word for words in vocabulary.values() for word in words]
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(filler) for _ in range(rng.randint(4, 12))]
+        if rng.random() < trigger_rate:
+            words.insert(rng.randrange(len(words)), rng.choice(all_triggers))
+        messages.append(" ".join(words).capitalize() + "!")
+    return messages
+
+
+def substring_scan(message: str, vocabulary):
+    """The pre-MoodClassifier approach: any(word in message) per mood, in priority order"""
+    message_lower = message.lower()
+    for mood in MOODS:
+        if any(word in message_lower for word in vocabulary[mood]):
+            return mood
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--triggers", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.triggers, rng)
+    messages = make_messages(args.messages, vocabulary, rng)
+
+    started = time.perf_counter()
+    classifier = MoodClassifier([
+        MoodRule(mood, words, priority=len(MOODS) - i) for i, (mood, words) in enumerate(vocabulary.items())
+    ])
+    compile_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scanned = [substring_scan(message, vocabulary) for message in messages]
+    scan_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    classified = classifier.classify_batch(messages)
+    classify_seconds = time.perf_counter() - started
+
+    # The scan also matches triggers inside longer words, so results can differ
+    differ = sum(1 for a, b in zip(scanned, classified) if a != b)
+
+    print(f"Triggers: {args.triggers}, messages: {args.messages}")
+    print(f"Compile:        {compile_seconds * 1000:.1f} ms")
+    print(f"Substring scan: {scan_seconds / len(messages) * 1e6:.1f} us/message")
+    print(f"MoodClassifier: {classify_seconds / len(messages) * 1e6:.1f} us/message")
+    print(f"Speedup:        {scan_seconds / classify_seconds:.0f}x")
+    print(f"Different results (substring false positives): {differ}")
+
+
+if __name__ == "__main__":
+    main()
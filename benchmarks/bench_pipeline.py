@@ -0,0 +1,259 @@
+"""
+End-to-end throughput and latency of EnhancedNPCSystem on a synthetic feed.
+
+Generates --players players sending --messages-per-player messages each,
+arriving up to --skew seconds out of timestamp order, with a mood trigger
+word in --trigger-density of them. The feed is written as ndjson, then
+ingested, ordered, run through process_message against the in-process fake
+LLM (npc_backend.FakeChatModel) and logged the way npc_chat.py does it.
+
+Reports messages/s, per-message latency percentiles, peak RSS and, from a
+second run under tracemalloc, the memory allocated while handling a message
+(mean per-message peak) and the memory it leaves behind. Python has no
+per-call allocation counter, so those two stand in for "allocations".
+Results are saved as JSON tagged with the git commit; pass an earlier file
+to --compare to see what changed.
+
+Usage: python benchmarks/bench_pipeline.py [--players 200] [--messages-per-player 10] [--skew 30]
+       [--trigger-density 0.3] [--memory native] [--compare logs/bench/pipeline-<commit>.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+try:
+    import resource
+except ImportError:  # Windows; peak RSS is reported as None
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from npc_backend import LLMBackend
+from npc_chat import MOOD_RULES, EnhancedNPCSystem
+from npc_ingest import (IngestStats, WatermarkReorderBuffer, format_timestamp, iter_messages, reorder_stream,
+                        sort_messages, timestamp_key)
+from npc_logs import create_log_writer
+
+FILLER = ["Where can I find the blacksmith?", "Any news from the east road?", "I need a room for the night.",
+          "What do you sell here?", "Tell me about the ruins.", "Is the forest safe to cross?",
+          "Who runs this village?", "I'm looking for work."]
+# Trigger words of the runner's own mood rules, prefix triggers ('thank*') as the bare word
+TRIGGERS = [trigger.rstrip("*") for rule in MOOD_RULES for trigger in rule.triggers]
+START = timestamp_key("2025-08-26T15:00:00")
+
+# Keys compared by --compare, and whether higher is better
+METRICS = [("messages_per_second", True), ("p50_ms", False), ("p95_ms", False), ("p99_ms", False),
+           ("peak_rss_mib", False), ("alloc_peak_kib_per_message", False), ("retained_kib_per_message", False)]
+
+
+# -----------------------------
+# Feed
+# -----------------------------
+
+def make_feed(players: int, per_player: int, skew: float, trigger_density: float, rng: random.Random):
+    """Records in arrival order: each message turns up to skew seconds after its timestamp"""
+    records = []
+    for player_id in range(1, players + 1):
+        ts_us = START + rng.randrange(60 * 1000000)  # players join over the first minute
+        for _ in range(per_player):
+            ts_us += rng.randint(2, 30) * 1000000
+            text = rng.choice(FILLER)
+            if rng.random() < trigger_density:
+                text = f"{rng.choice(TRIGGERS).capitalize()}! {text}"
+            records.append((ts_us + rng.uniform(0, skew) * 1000000, ts_us, player_id, text))
+    records.sort()
+    return [{'player_id': player_id, 'text': text, 'timestamp': format_timestamp(ts_us)}
+            for _, ts_us, player_id, text in records]
+
+
+def ordered_messages(path: str, order: str, lateness: float):
+    messages = iter_messages(path, IngestStats())
+    if order == "memory":
+        return sort_messages(messages)
+    return reorder_stream(messages, WatermarkReorderBuffer(lateness))
+
+
+# -----------------------------
+# Runs
+# -----------------------------
+
+def make_system(args) -> EnhancedNPCSystem:
+    return EnhancedNPCSystem("sk-bench", backend=LLMBackend("fake"), memory_mode=args.memory,
+                             history_mode=args.history)
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def peak_rss_mib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+
+def timed_run(args, feed_path: str, log_path: str):
+    system = make_system(args)
+    latencies = []
+    with create_log_writer(log_path) as log:
+        started = time.perf_counter()
+        for msg in ordered_messages(feed_path, args.order, args.lateness):
+            t0 = time.perf_counter()
+            log.write(system.process_message(msg.player_id, msg.text, msg.timestamp))
+            latencies.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+        system.close()
+    return elapsed, latencies
+
+
+def traced_run(args, feed_path: str, log_path: str):
+    """Per-message allocation peak and retained memory, on a fresh system for the first --trace-messages"""
+    system = make_system(args)
+    peaks = []
+    with create_log_writer(log_path) as log:
+        messages = ordered_messages(feed_path, args.order, args.lateness)
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for count, msg in enumerate(messages, 1):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            log.write(system.process_message(msg.player_id, msg.text, msg.timestamp))
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            if count >= args.trace_messages:
+                break
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        system.close()
+    return sum(peaks) / len(peaks), retained / len(peaks)
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(previous: dict, current: dict):
+    print(f"Compared with {previous['commit']} ({previous['created']}):")
+    for key, higher_is_better in METRICS:
+        old, new = previous['results'].get(key), current['results'].get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        better = change > 0 if higher_is_better else change < 0
+        print(f"  {key:<28} {old:>10} -> {new:<10} {change:+7.1%} {'better' if better else 'worse'}")
+    if previous['config'] != current['config']:
+        print("  note: the runs used different settings")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--messages-per-player", type=int, default=10)
+    parser.add_argument("--skew", type=float, default=30.0,
+                        help="Seconds a message may arrive after its timestamp (0: the feed is in order)")
+    parser.add_argument("--trigger-density", type=float, default=0.3,
+                        help="Share of messages containing a mood trigger word")
+    parser.add_argument("--order", choices=["memory", "watermark"], default="memory")
+    parser.add_argument("--lateness", type=float, default=None, help="Watermark lateness (default: --skew)")
+    parser.add_argument("--memory", choices=["langchain", "native"], default="langchain")
+    parser.add_argument("--history", choices=["full", "delta"], default="full")
+    parser.add_argument("--trace-messages", type=int, default=500,
+                        help="Messages run under tracemalloc for the allocation figures (0 skips them)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default=None,
+                        help="Results file (default: logs/bench/pipeline-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    args = parser.parse_args()
+    if args.lateness is None:
+        args.lateness = args.skew
+    warnings.simplefilter("ignore")  # LangChain deprecation warnings on every chain
+
+    rng = random.Random(args.seed)
+    feed = make_feed(args.players, args.messages_per_player, args.skew, args.trigger_density, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        feed_path = os.path.join(tmp, "feed.ndjson")
+        with open(feed_path, "w", encoding="utf-8") as f:
+            for record in feed:
+                f.write(json.dumps(record) + "\n")
+
+        elapsed, latencies = timed_run(args, feed_path, os.path.join(tmp, "run.jsonl"))
+        rss = peak_rss_mib()
+        alloc_peak = retained = None
+        if args.trace_messages:
+            alloc_peak, retained = traced_run(args, feed_path, os.path.join(tmp, "traced.jsonl"))
+
+    latencies.sort()
+    commit = git_commit()
+    report = {
+        'benchmark': "pipeline",
+        'commit': commit,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: getattr(args, key) for key in ("players", "messages_per_player", "skew", "trigger_density",
+                                                       "order", "lateness", "memory", "history", "seed")},
+        'results': {
+            'messages': len(latencies),
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(len(latencies) / elapsed, 1),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3),
+            'peak_rss_mib': rss,
+            'alloc_peak_kib_per_message': round(alloc_peak / 1024, 2) if alloc_peak is not None else None,
+            'retained_kib_per_message': round(retained / 1024, 2) if retained is not None else None,
+        },
+    }
+
+    results = report['results']
+    print(f"Feed: {args.players} players x {args.messages_per_player} messages, skew {args.skew}s, "
+          f"trigger density {args.trigger_density}; memory {args.memory}, history {args.history}")
+    print(f"Throughput: {results['messages_per_second']:,} messages/s ({results['messages']} in {results['seconds']}s)")
+    print(f"Latency:    p50 {results['p50_ms']}ms  p95 {results['p95_ms']}ms  p99 {results['p99_ms']}ms  "
+          f"max {results['max_ms']}ms")
+    print(f"Memory:     peak RSS {rss} MiB")
+    if alloc_peak is not None:
+        print(f"Allocation: {results['alloc_peak_kib_per_message']} KiB peak per message, "
+              f"{results['retained_kib_per_message']} KiB retained per message "
+              f"(first {args.trace_messages} messages under tracemalloc)")
+
+    output = args.output or os.path.join(ROOT, "logs", "bench", f"pipeline-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Per-stage cost of EnhancedNPCSystem.process_message, against the fake LLM.
+
+Warms --players players with --turns turns each, then times every stage of
+process_message on its own, cycling through the players and a fixed set of
+messages: chain lookup (hot player), chain creation (new player), mood
+update, prompt template lookup and application, the model call (the fake
+LLM's share is tiny, so this is LangChain plus memory bookkeeping), history
+extraction and result construction, then the whole process_message for
+reference.
+
+Uses timeit (best of --repeat) by default and saves the per-stage means to
+logs/bench/stages-<commit>.json; --compare an earlier file to catch
+regressions. With pyperf installed, --pyperf runs each stage through
+pyperf.Runner instead (worker processes, calibrated loops, -o/--compare-to
+are pyperf's own).
+
+Usage: python benchmarks/bench_stages.py [--players 100] [--turns 4] [--memory native] [--number 2000]
+       python benchmarks/bench_stages.py --pyperf -o stages.json
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import timeit
+import warnings
+
+try:
+    import pyperf
+except ImportError:  # --pyperf is unavailable, timeit is used
+    pyperf = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench_pipeline import git_commit
+from npc_backend import LLMBackend
+from npc_chat import EnhancedNPCSystem, NPCMood
+
+MESSAGES = ["Hello there!", "Where can I find the blacksmith?", "Do you have a quest for me?",
+            "This village is useless and I hate it", "I'm lost, I don't understand the map",
+            "Thanks for the help, friend."]
+TIMESTAMP = "2025-08-26T15:01:10"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=4, help="Turns each player has before timing starts")
+    parser.add_argument("--memory", choices=["langchain", "native"], default="langchain")
+    parser.add_argument("--history", choices=["full", "delta"], default="full")
+
+
+def build_stages(args):
+    """(name, function) per stage, each call doing one unit of that stage's work"""
+    system = EnhancedNPCSystem("sk-bench", backend=LLMBackend("fake"), memory_mode=args.memory,
+                               history_mode=args.history)
+    for turn in range(args.turns):
+        for player_id in range(args.players):
+            system.process_message(player_id, MESSAGES[(player_id + turn) % len(MESSAGES)], TIMESTAMP)
+
+    players = itertools.cycle(range(args.players))
+    messages = itertools.cycle(MESSAGES)
+    new_players = itertools.count(args.players)
+    prompts = itertools.cycle([(npc_key, mood) for npc_key in system.npc_personalities for mood in NPCMood])
+
+    def turn():
+        player_id = next(players)
+        chain, state = system._ensure_player(player_id)
+        return player_id, chain, state, system.npc_personalities[state.npc_key]
+
+    def lookup():
+        system._ensure_player(next(players))
+
+    def create():
+        system._ensure_player(next(new_players))
+
+    def mood():
+        system.update_npc_mood(next(players), next(messages))
+
+    def prompt_template():
+        system.get_npc_prompt_template(*next(prompts))
+
+    def apply_prompt():
+        _, chain, state, _ = turn()
+        system._apply_prompt(chain, state)
+
+    def predict():
+        _, chain, state, npc = turn()
+        system._predict(chain, state.npc_key, npc, state.mood, next(messages))
+
+    def history():
+        system._conversation_history(turn()[1])
+
+    def result():
+        player_id, chain, state, npc = turn()
+        system._build_result(chain, state, npc, state.mood, player_id, next(messages), TIMESTAMP,
+                             "Well met, traveler.", recorded=False)
+
+    def process_message():
+        system.process_message(next(players), next(messages), TIMESTAMP)
+
+    return system, [
+        ("lookup", lookup), ("create", create), ("mood", mood), ("prompt_template", prompt_template),
+        ("apply_prompt", apply_prompt), ("predict", predict), ("history", history), ("result", result),
+        ("process_message", process_message),
+    ]
+
+
+def run_pyperf():
+    def add_cmdline_args(cmd, args):
+        cmd.extend(["--pyperf", "--players", str(args.players), "--turns", str(args.turns),
+                    "--memory", args.memory, "--history", args.history])
+
+    runner = pyperf.Runner(add_cmdline_args=add_cmdline_args)
+    runner.argparser.add_argument("--pyperf", action="store_true")
+    add_arguments(runner.argparser)
+    args = runner.parse_args()
+    system, stages = build_stages(args)
+    for name, func in stages:
+        runner.bench_func(f"npc_{args.memory}_{name}", func)
+
+
+def run_timeit(args):
+    system, stages = build_stages(args)
+    means = {}
+    for name, func in stages:
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        means[name] = best / args.number * 1e6
+    system.close()
+    return means
+
+
+def main():
+    warnings.simplefilter("ignore")  # LangChain deprecation warnings on every chain
+
+    if "--pyperf" in sys.argv:
+        if pyperf is None:
+            sys.exit("--pyperf needs pyperf (pip install pyperf)")
+        run_pyperf()
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--number", type=int, default=2000, help="Calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="Timings per stage; the best one is kept")
+    parser.add_argument("--output", default=None, help="Results file (default: logs/bench/stages-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    means = run_timeit(args)
+
+    total = means["process_message"]
+    stage_sum = sum(mean for name, mean in means.items() if name not in ("create", "process_message"))
+    print(f"Players: {args.players} with {args.turns} turns each, memory {args.memory}, history {args.history}")
+    print(f"{'stage':<16} {'us/call':>10} {'of process_message':>19}")
+    for name, mean in means.items():
+        print(f"{name:<16} {mean:>10.2f} {mean / total:>18.0%}")
+    print(f"Stages other than create add up to {stage_sum:.1f} us of {total:.1f} us; the rest is the glue "
+          f"between stages and run-to-run noise")
+
+    commit = git_commit()
+    report = {
+        'benchmark': "stages",
+        'commit': commit,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'config': {key: getattr(args, key) for key in ("players", "turns", "memory", "history", "number")},
+        'results': {name: round(mean, 3) for name, mean in means.items()},
+    }
+    output = args.output or os.path.join(ROOT, "logs", "bench", f"stages-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        print(f"Compared with {previous['commit']} ({previous['created']}), us/call:")
+        for name, mean in report['results'].items():
+            old = previous['results'].get(name)
+            if old:
+                print(f"  {name:<16} {old:>10} -> {mean:<10} {(mean - old) / old:+7.1%}")
+        if previous['config'] != report['config']:
+            print("  note: the runs used different settings")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import time
+from typing import Dict, Any, List, Optional
+
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import ChatOpenAI
+
+from npc_mock_llm import MockLLMServer, add_mock_arguments, mock_options, mock_reply
+from npc_tokens import HeuristicTokenizer, TokenCounter
+
+
+# -----------------------------
+# LLM backends
+# -----------------------------
+
+BACKENDS = ("openai", "mock", "fake")
+
+_offline_counter = TokenCounter(HeuristicTokenizer())
+
+
+class OfflineTokenCounts:
+    """Token counts that never need network access, for chat models used offline.
+
+    LangChain's summary memories count tokens with the model's tiktoken
+    encoding, which is downloaded on first use. Against the mock server
+    that download would be the only thing leaving the machine, so counts
+    come from the heuristic tokenizer instead.
+    """
+
+    def get_num_tokens(self, text: str) -> int:
+        return _offline_counter.count(text)
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage], tools=None) -> int:
+        return sum(_offline_counter.count_message(str(message.content)) for message in messages)
+
+
+class OfflineChatOpenAI(OfflineTokenCounts, ChatOpenAI):
+    """ChatOpenAI for the mock server or another --base-url endpoint"""
+
+
+class FakeChatModel(OfflineTokenCounts, BaseChatModel):
+    """In-process deterministic chat model: the mock server's replies without HTTP.
+
+    The same prompt always gets the same reply, so runs can be compared
+    byte for byte, and what gets timed is this repo's own code.
+    """
+
+    delay_seconds: float = 0.0
+    seed: int = 0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "npc-fake"
+
+    def _reply(self, messages: List[BaseMessage]) -> ChatResult:
+        self.calls += 1
+        reply = mock_reply([{'content': message.content} for message in messages], self.seed)
+        input_tokens = self.get_num_tokens_from_messages(messages)
+        output_tokens = self.get_num_tokens(reply)
+        usage = {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                 'total_tokens': input_tokens + output_tokens}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply, usage_metadata=usage))])
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.delay_seconds:
+            time.sleep(self.delay_seconds)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.delay_seconds:
+            await asyncio.sleep(self.delay_seconds)
+        return self._reply(messages)
+
+
+class LLMBackend:
+    """Where chat completions are sent, shared by npc_chat.py and npc_chat_v1.
+
+    - openai: the OpenAI API, or any OpenAI-compatible server at base_url
+      (vLLM, a proxy, a separately started npc_mock_llm.py).
+    - mock: a MockLLMServer started in this process on a free port; no
+      API key or network needed.
+    - fake: FakeChatModel, the same replies with no server at all. Only
+      EnhancedNPCSystem can use it (NPCChatSystem needs an OpenAI client).
+
+    chat_model() gives the LangChain model EnhancedNPCSystem uses and
+    client() the plain OpenAI client NPCChatSystem uses; both talk to the
+    same endpoint.
+    """
+
+    def __init__(self, kind: str = "openai", base_url: Optional[str] = None,
+                 mock: Optional[Dict[str, Any]] = None):
+        if kind not in BACKENDS:
+            raise ValueError(f"Unknown LLM backend: {kind}")
+        self.kind = kind
+        self.base_url = base_url
+        self.server = None
+        if kind == "mock":
+            self.server = MockLLMServer(**(mock or {})).start()
+            self.base_url = self.server.url
+
+    @property
+    def offline_tokens(self) -> bool:
+        """Whether token counts must not download tiktoken's vocabulary: anything but the OpenAI API itself"""
+        return self.kind != "openai" or self.base_url is not None
+
+    def api_key(self, api_key: Optional[str]) -> Optional[str]:
+        # The mock (or whatever serves base_url) accepts anything, but the clients refuse to start without a key
+        return api_key or ("sk-mock" if self.offline_tokens else None)
+
+    def chat_model(self, api_key: Optional[str], **options) -> BaseChatModel:
+        if self.kind == "fake":
+            return FakeChatModel()
+        model_cls = OfflineChatOpenAI if self.offline_tokens else ChatOpenAI
+        return model_cls(api_key=self.api_key(api_key), base_url=self.base_url, **options)
+
+    def client(self, api_key: Optional[str]) -> openai.OpenAI:
+        if self.kind == "fake":
+            raise ValueError("The fake backend has no HTTP endpoint; use --backend mock")
+        return openai.OpenAI(api_key=self.api_key(api_key), base_url=self.base_url)
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {'backend': self.kind, 'base_url': self.base_url}
+        if self.server is not None:
+            stats['mock'] = self.server.stats()
+        return stats
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser) -> None:
+    """--backend, --base-url and the --mock-* server options"""
+    parser.add_argument("--backend", choices=BACKENDS, default="openai",
+                        help="openai: the OpenAI API (or --base-url); mock: a local mock server, no key or network; "
+                             "fake: the mock's replies in-process, without HTTP (npc_chat.py only)")
+    parser.add_argument("--base-url", default=None,
+                        help="OpenAI-compatible endpoint to send requests to, e.g. http://127.0.0.1:8000/v1")
+    add_mock_arguments(parser, prefix="mock-")
+
+
+def backend_from_args(args: argparse.Namespace) -> LLMBackend:
+    return LLMBackend(args.backend, base_url=args.base_url, mock=mock_options(args, prefix="mock-"))
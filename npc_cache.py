@@ -0,0 +1,364 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # only needed by the semantic cache
+    np = None
+
+
+# -----------------------------
+# Cache keys
+# -----------------------------
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[.!]+$")
+
+def normalize_player_text(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing '.'/'!' so trivial variants share a key"""
+    text = _WHITESPACE.sub(" ", text.strip().lower())
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+def history_digest(history: List[Tuple[str, str]]) -> str:
+    """Hash a conversation window given as (role, content) pairs"""
+    digest = hashlib.sha256()
+    for role, content in history:
+        digest.update(role.encode())
+        digest.update(b"\x1f")
+        digest.update(content.encode())
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+def make_cache_key(npc_key: str, mood: str, history: List[Tuple[str, str]], player_text: str) -> str:
+    """Build the exact-match key for one turn: NPC, mood, recent history and normalized input"""
+    parts = [npc_key, mood, history_digest(history), normalize_player_text(player_text)]
+    return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+
+# -----------------------------
+# Response caches
+# -----------------------------
+
+class ResponseCache:
+    """Interface for NPC response caches.
+
+    Implementations must be safe to call from several threads (lanes mode).
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def put(self, key: str, response: str) -> None:
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class LRUResponseCache(ResponseCache):
+    """In-memory LRU cache with an optional time-to-live per entry"""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: Optional[float] = None):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            response, expires_at = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else 0.0
+        with self._lock:
+            self._entries[key] = (response, expires_at)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """On-disk cache that survives restarts, so nightly replays can reuse earlier runs"""
+
+    def __init__(self, path: str = "logs/response_cache.sqlite3", max_entries: int = 100000,
+                 ttl_seconds: Optional[float] = None):
+        super().__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+        # COUNT(*) is a table scan in SQLite, so track the size ourselves
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            response, created_at = row
+            if self.ttl_seconds and created_at + self.ttl_seconds < now:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._size -= 1
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self.stores += 1
+            if not exists:
+                self._size += 1
+
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (overflow,)
+                )
+                self._size -= overflow
+                self.evictions += overflow
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_response_cache(kind: str, path: Optional[str] = None, max_entries: int = 10000,
+                          ttl_seconds: Optional[float] = None) -> Optional[ResponseCache]:
+    """Build a cache from a runner option ('none', 'memory' or 'sqlite')"""
+    if kind == "none":
+        return None
+    if kind == "memory":
+        return LRUResponseCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+    if kind == "sqlite":
+        return SQLiteResponseCache(path or "logs/response_cache.sqlite3", max_entries=max_entries,
+                                   ttl_seconds=ttl_seconds)
+    raise ValueError(f"Unknown response cache: {kind}")
+
+
+# -----------------------------
+# Semantic cache
+# -----------------------------
+
+class HashedNgramEmbedder:
+    """CPU-only text embedding: character n-grams hashed into a fixed-size vector.
+
+    No model download and ~microseconds per message. It captures spelling
+    and word overlap ("where's the smith" ~ "where is the smith?"), not deep
+    paraphrase; pass any object with the same embed() signature to
+    SemanticResponseCache to use a real local embedding model instead.
+    """
+
+    def __init__(self, dim: int = 512, ngram_sizes: Tuple[int, ...] = (3, 4)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def embed(self, text: str) -> "np.ndarray":
+        vector = np.zeros(self.dim, dtype=np.float32)
+        padded = f" {normalize_player_text(text)} "
+        for n in self.ngram_sizes:
+            for i in range(len(padded) - n + 1):
+                h = zlib.crc32(padded[i:i + n].encode())
+                # The top bit picks a sign so colliding n-grams tend to cancel out
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = float(np.linalg.norm(vector))
+        if norm:
+            vector /= norm
+        return vector
+
+
+class _VectorIndex:
+    """Unit vectors for one (npc_key, mood) in a growable matrix; oldest entries are overwritten when full"""
+
+    def __init__(self, dim: int, max_entries: int):
+        self.max_entries = max_entries
+        self.vectors = np.zeros((min(64, max_entries), dim), dtype=np.float32)
+        self.responses: List[str] = []
+        self.size = 0
+        self.next_slot = 0
+
+    def search(self, vector: "np.ndarray") -> Tuple[int, float]:
+        if self.size == 0:
+            return -1, 0.0
+        similarities = self.vectors[:self.size] @ vector
+        best = int(np.argmax(similarities))
+        return best, float(similarities[best])
+
+    def add(self, vector: "np.ndarray", response: str) -> bool:
+        """Store a vector; returns True when an old entry was overwritten"""
+        if self.size < self.max_entries:
+            if self.size == len(self.vectors):
+                grown = np.zeros((min(len(self.vectors) * 2, self.max_entries), self.vectors.shape[1]),
+                                 dtype=np.float32)
+                grown[:self.size] = self.vectors[:self.size]
+                self.vectors = grown
+            self.vectors[self.size] = vector
+            self.responses.append(response)
+            self.size += 1
+            return False
+
+        self.vectors[self.next_slot] = vector
+        self.responses[self.next_slot] = response
+        self.next_slot = (self.next_slot + 1) % self.max_entries
+        return True
+
+
+class SemanticResponseCache:
+    """Nearest-neighbour reply cache per (npc_key, mood).
+
+    A lookup embeds the player message and serves the reply of the most
+    similar cached message when the cosine similarity reaches threshold.
+    The best similarity of every lookup is kept in a histogram so the
+    threshold can be tuned against reply quality.
+    """
+
+    HISTOGRAM_BINS = 20
+
+    def __init__(self, threshold: float = 0.9, embedder=None, max_entries_per_index: int = 5000):
+        if np is None:
+            raise ImportError("SemanticResponseCache requires numpy (pip install numpy)")
+        self.threshold = threshold
+        self.embedder = embedder or HashedNgramEmbedder()
+        self.max_entries_per_index = max_entries_per_index
+        self._indexes: Dict[Tuple[str, str], _VectorIndex] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.similarity_histogram = [0] * self.HISTOGRAM_BINS
+        self._hit_similarity_total = 0.0
+
+    def get(self, npc_key: str, mood: str, text: str) -> Optional[str]:
+        vector = self.embedder.embed(text)
+        with self._lock:
+            index = self._indexes.get((npc_key, mood))
+            if index is None or index.size == 0:
+                self.misses += 1
+                return None
+
+            slot, similarity = index.search(vector)
+            bucket = min(int(max(similarity, 0.0) * self.HISTOGRAM_BINS), self.HISTOGRAM_BINS - 1)
+            self.similarity_histogram[bucket] += 1
+
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._hit_similarity_total += similarity
+            return index.responses[slot]
+
+    def put(self, npc_key: str, mood: str, text: str, response: str) -> None:
+        vector = self.embedder.embed(text)
+        with self._lock:
+            index = self._indexes.get((npc_key, mood))
+            if index is None:
+                index = _VectorIndex(len(vector), self.max_entries_per_index)
+                self._indexes[(npc_key, mood)] = index
+            if index.add(vector, response):
+                self.evictions += 1
+            self.stores += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': sum(index.size for index in self._indexes.values()),
+            'indexes': len(self._indexes),
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'mean_hit_similarity': round(self._hit_similarity_total / self.hits, 4) if self.hits else None,
+            # Counts of best-match similarity per bucket of width 1/HISTOGRAM_BINS, starting at 0.0
+            'similarity_histogram': list(self.similarity_histogram),
+        }
+
+    def close(self) -> None:
+        pass
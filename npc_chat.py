@@ -1,18 +1,38 @@
 #from langchain.llms import OpenAI
-from langchain_openai import ChatOpenAI
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.chains import ConversationChain
-from langchain.prompts import PromptTemplate
+from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
 from langchain.schema import BaseMemory
-import json
+from langchain_core.messages import (AIMessage, BaseMessage, HumanMessage, SystemMessage, messages_from_dict,
+                                     messages_to_dict)
+import argparse
+import asyncio
+import itertools
 import os
-from typing import Dict, Any, List
-from datetime import datetime
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, List, Callable, Iterable, Optional, Tuple, Union
 from dataclasses import dataclass
 from enum import Enum
 from dotenv import load_dotenv
 
+from npc_backend import LLMBackend, add_backend_arguments, backend_from_args
+from npc_checkpoint import CheckpointStore
+from npc_cache import ResponseCache, SemanticResponseCache, create_response_cache, make_cache_key
+from npc_memory import BackgroundSummarizer, BackgroundSummaryBufferMemory, NativeConversationMemory, StringPool
+from npc_ingest import (IngestStats, PlayerMessage, SortStats, WatermarkReorderBuffer, external_sort, iter_messages,
+                        reorder_stream, sort_messages)
+from npc_logs import LOG_FORMATS, conversation_id, create_log_writer, log_format_for_path
+from npc_metrics import NULL_METRICS, Metrics, MetricsDumper, MetricsServer, TokenUsageCallback
+from npc_mood import MoodClassifier, MoodRule
+from npc_state import SQLitePlayerStore
+from npc_tokens import ContextBudget, HeuristicTokenizer, PrefixReuseTracker, TokenCounter, load_tokenizer
+from npc_tracing import NULL_TRACER, JsonlSpanExporter, TraceTokensCallback, Tracer
+
 
 # -----------------------------
 # NPC Enums and Personality
@@ -31,50 +51,46 @@ class NPCPersonality:
     role: str
     background: str
     quirks: List[str]
-    mood: NPCMood = NPCMood.NEUTRAL
+    mood: NPCMood = NPCMood.NEUTRAL  # starting mood for each new player
+
+
+class PlayerNPCState:
+    """Mood of one NPC towards one player, plus how many turns they have had.
+    
+    Each player has their own copy, so players sharing an NPC don't overwrite
+    each other's mood and concurrent runners never write the same object.
+    """
+    __slots__ = ("npc_key", "mood", "turns")
+    
+    def __init__(self, npc_key: str, mood: NPCMood = NPCMood.NEUTRAL):
+        self.npc_key = npc_key
+        self.mood = mood
+        self.turns = 0
+    
+    def __repr__(self):
+        return f"PlayerNPCState(npc_key={self.npc_key!r}, mood={self.mood}, turns={self.turns})"
+
+
+# Checked together; on overlap the higher priority wins (angry beats everything)
+MOOD_RULES = [
+    MoodRule(NPCMood.ANGRY.value, ['stupid*', 'useless', 'hate*', 'idiot*'], priority=4),
+    MoodRule(NPCMood.HELPFUL.value, ['help*', 'please', 'quest', 'quests', 'thank*'], priority=3),
+    MoodRule(NPCMood.FRIENDLY.value, ['hello', 'hi', 'nice', 'good'], priority=2),
+    MoodRule(NPCMood.CONFUSED.value, ['confus*', 'lost', 'understand*'], priority=1),
+]
 
 # -----------------------------
-# NPC System
+# Prompt templates
 # -----------------------------
 
-class EnhancedNPCSystem:
-    def __init__(self, api_key: str):
-        self.llm = ChatOpenAI(
-            model="gpt-3.5-turbo",
-            temperature=0.7,
-            api_key=api_key,
-            max_tokens=150
-        )
-        
-        # Different NPC personalities
-        self.npc_personalities = {
-            "village_guard": NPCPersonality(
-                name="Marcus",
-                role="Village Guard",
-                background="A veteran soldier who protects the village",
-                quirks=["Always mentions his war stories", "Suspicious of strangers"]
-            ),
-            "merchant": NPCPersonality(
-                name="Elena",
-                role="Merchant",
-                background="A traveling trader with exotic goods",
-                quirks=["Always trying to make a sale", "Knows gossip from other towns"]
-            ),
-            "blacksmith": NPCPersonality(
-                name="Thorin",
-                role="Blacksmith",
-                background="Master craftsman who forges weapons and tools",
-                quirks=["Speaks in short sentences", "Proud of his work"]
-            )
-        }
-        
-        self.player_conversations: Dict[int, ConversationChain] = {}
-        self.player_npc_assignments: Dict[int, str] = {}
-        
-    def get_npc_prompt_template(self, npc_key: str) -> PromptTemplate:
-        npc = self.npc_personalities[npc_key]
-        
-        template = f"""=== GAME WORLD CONTEXT ===
+def build_npc_system_prefix(npc: NPCPersonality) -> str:
+    """The part of an NPC's prompt that never changes between calls.
+    
+    Everything that varies (mood, history, the player's message) comes
+    after it, so every call for this NPC starts with the same bytes and
+    provider-side prompt caching can reuse it.
+    """
+    return f"""=== GAME WORLD CONTEXT ===
 You are an NPC (Non-Player Character) in "Chronicles of Aethermoor," a medieval fantasy RPG set in a bustling village at the crossroads of ancient kingdoms. This village serves as a safe haven for adventurers, traders, and travelers seeking quests, supplies, and information.
 
 The village contains:
@@ -93,8 +109,6 @@ Role: {npc.role}
 Background: {npc.background}
 Personality Quirks: {', '.join(npc.quirks)}
 
-Current Emotional State: {npc.mood.value}
-
 === MOOD-BASED BEHAVIOR GUIDE ===
 
 When NEUTRAL:
@@ -147,175 +161,1254 @@ When CONFUSED:
 7. **Use Medieval Fantasy Language**: Avoid modern slang, but keep it understandable
 
 === INTERACTION HISTORY ===
-Previous conversation with this adventurer:
-{{history}}
+Your previous conversation with this adventurer follows, then their new message."""
+
+
+def build_npc_turn_template(npc: NPCPersonality, mood: NPCMood) -> str:
+    """The message after the history: current mood and the player's {input}"""
+    return f"""Current Emotional State: {mood.value}
 
 === CURRENT INTERACTION ===
 The adventurer approaches you and says: {{input}}
 
-*{npc.name} {npc.mood.value.replace('_', ' ')} responds:*"""
+*{npc.name} {mood.value.replace('_', ' ')} responds:*"""
+
+
+def build_npc_prompt_template(prefix: str, turn_template: str) -> ChatPromptTemplate:
+    """System prefix, then the {history} messages, then the turn message"""
+    return ChatPromptTemplate.from_messages([
+        # A ready message, not a template: sent exactly as built
+        SystemMessage(content=prefix),
+        MessagesPlaceholder(variable_name="history"),
+        HumanMessagePromptTemplate.from_template(turn_template),
+    ])
+
+
+class PromptTemplateRegistry:
+    """Builds each (NPC, mood) prompt once and hands out the same ChatPromptTemplate afterwards.
+    
+    Templates only depend on the personality and the mood, so with 3 NPCs and
+    5 moods there are just 15 of them. All moods of an NPC share one system
+    prefix string. Call invalidate() after editing an NPCPersonality
+    (EnhancedNPCSystem.update_npc_personality does this).
+    """
+    
+    def __init__(self, personalities: Dict[str, NPCPersonality]):
+        self.personalities = personalities
+        self.prefixes: Dict[str, str] = {}
+        self.turn_templates: Dict[Tuple[str, NPCMood], str] = {}
+        self.templates: Dict[Tuple[str, NPCMood], ChatPromptTemplate] = {}
+        self.builds = 0
+    
+    def prefix(self, npc_key: str) -> str:
+        """The NPC's system prefix, the same object on every call"""
+        prefix = self.prefixes.get(npc_key)
+        if prefix is None:
+            prefix = build_npc_system_prefix(self.personalities[npc_key])
+            self.prefixes[npc_key] = prefix
+        return prefix
+    
+    def get(self, npc_key: str, mood: NPCMood) -> ChatPromptTemplate:
+        template = self.templates.get((npc_key, mood))
+        if template is None:
+            turn_template = build_npc_turn_template(self.personalities[npc_key], mood)
+            template = build_npc_prompt_template(self.prefix(npc_key), turn_template)
+            self.turn_templates[(npc_key, mood)] = turn_template
+            self.templates[(npc_key, mood)] = template
+            self.builds += 1
+        return template
+    
+    def warm(self):
+        """Build every (NPC, mood) combination up front"""
+        for npc_key in self.personalities:
+            for mood in NPCMood:
+                self.get(npc_key, mood)
+    
+    def invalidate(self, npc_key: Optional[str] = None):
+        """Drop cached templates for one NPC, or all of them"""
+        if npc_key is None:
+            self.prefixes.clear()
+            self.turn_templates.clear()
+            self.templates.clear()
+        else:
+            self.prefixes.pop(npc_key, None)
+            for mood in NPCMood:
+                self.turn_templates.pop((npc_key, mood), None)
+                self.templates.pop((npc_key, mood), None)
+
+# -----------------------------
+# NPC System
+# -----------------------------
+
+# A player's conversation: a LangChain chain, or the native memory in "native" memory mode
+Conversation = Union[ConversationChain, NativeConversationMemory]
 
-        return PromptTemplate(
-            input_variables=["history", "input"],
-            template=template
+class EnhancedNPCSystem:
+    def __init__(self, api_key: str, response_cache: Optional[ResponseCache] = None,
+                 cache_history_window: int = 6, semantic_cache: Optional[SemanticResponseCache] = None,
+                 summary_mode: str = "background", history_mode: str = "full",
+                 player_store: Optional[SQLitePlayerStore] = None, max_hot_players: Optional[int] = None,
+                 track_dirty_players: bool = False, memory_mode: str = "langchain", memory_turns: int = 6,
+                 prompt_tokens: Optional[int] = None, tokenizer_vocab: Optional[str] = None,
+                 backend: Optional[LLMBackend] = None, metrics: Optional[Metrics] = None,
+                 tracer: Optional[Tracer] = None):
+        self.backend = backend or LLMBackend()
+        self.llm = self.backend.chat_model(
+            api_key,
+            model="gpt-3.5-turbo",
+            temperature=0.7,
+            max_tokens=150
         )
+        
+        # Without a registry or tracer every observe/inc/span is a no-op
+        self.metrics = metrics or NULL_METRICS
+        self.tracer = tracer or NULL_TRACER
+        callbacks = []
+        if self.metrics.enabled:
+            callbacks.append(TokenUsageCallback(self.metrics))
+        if self.tracer.enabled:
+            callbacks.append(TraceTokensCallback(self.tracer))
+        if callbacks:
+            self.llm.callbacks = callbacks
+        
+        # Different NPC personalities
+        self.npc_personalities = {
+            "village_guard": NPCPersonality(
+                name="Marcus",
+                role="Village Guard",
+                background="A veteran soldier who protects the village",
+                quirks=["Always mentions his war stories", "Suspicious of strangers"]
+            ),
+            "merchant": NPCPersonality(
+                name="Elena",
+                role="Merchant",
+                background="A traveling trader with exotic goods",
+                quirks=["Always trying to make a sale", "Knows gossip from other towns"]
+            ),
+            "blacksmith": NPCPersonality(
+                name="Thorin",
+                role="Blacksmith",
+                background="Master craftsman who forges weapons and tools",
+                quirks=["Speaks in short sentences", "Proud of his work"]
+            )
+        }
+        
+        # "background" moves the memory's summarization LLM calls off the
+        # request path; "inline" keeps LangChain's synchronous behaviour
+        if summary_mode not in ("background", "inline"):
+            raise ValueError(f"Unknown summary mode: {summary_mode}")
+        self.summarizer = BackgroundSummarizer(metrics=self.metrics) if summary_mode == "background" else None
+        
+        # "native" replaces the per-player ConversationChain and summary memory
+        # with a ring buffer of the last memory_turns turns whose texts live in
+        # one shared pool; the LLM is called directly with the cached prompt
+        if memory_mode not in ("langchain", "native"):
+            raise ValueError(f"Unknown memory mode: {memory_mode}")
+        self.memory_mode = memory_mode
+        self.memory_turns = memory_turns
+        self.string_pool = StringPool() if memory_mode == "native" else None
+        
+        self.mood_classifier = MoodClassifier(MOOD_RULES)
+        
+        # Every (NPC, mood) prompt is built once here and reused by reference
+        self.prompt_templates = PromptTemplateRegistry(self.npc_personalities)
+        self.prompt_templates.warm()
+        
+        # Optional prompt token budget: history is packed newest-first into
+        # whatever the fixed prompt and the player message leave over
+        # load_tokenizer may download tiktoken's vocabulary; offline backends
+        # (mock, fake, --base-url) only risk that when exact counts were asked for
+        if prompt_tokens is not None or tokenizer_vocab or not self.backend.offline_tokens:
+            counter = TokenCounter(load_tokenizer(tokenizer_vocab))
+        else:
+            counter = TokenCounter(HeuristicTokenizer())
+        self.token_counter = None
+        self.context_budget = None
+        self.history_token_limit = 200
+        if prompt_tokens is not None:
+            self.token_counter = counter
+            self.context_budget = ContextBudget(self.token_counter, prompt_tokens)
+            fixed = max(self._fixed_prompt_tokens(npc_key, mood) for npc_key, mood in self.prompt_templates.templates)
+            # LangChain memories get one limit for every turn; leave room for a long-ish message
+            self.history_token_limit = max(prompt_tokens - fixed - 100, 0)
+        
+        # How often a call starts with an NPC system prefix that was already sent
+        self.prefix_reuse = PrefixReuseTracker(counter)
+        
+        # Hot players, least recently used first. With max_hot_players set,
+        # the oldest idle players are serialized to player_store and rebuilt
+        # on their next message.
+        if max_hot_players is not None and player_store is None:
+            raise ValueError("max_hot_players needs a player_store for evicted players")
+        self.player_conversations: "OrderedDict[int, Conversation]" = OrderedDict()
+        self.player_states: Dict[int, PlayerNPCState] = {}
+        self.player_store = player_store
+        self.max_hot_players = max_hot_players
+        self._players_lock = threading.RLock()
+        self._in_flight: Dict[int, int] = {}  # players with a turn running; never evicted
+        self.hot_hits = 0
+        self.new_players = 0
+        self.rehydrations = 0
+        self.rehydrate_seconds = 0.0
+        self.max_rehydrate_seconds = 0.0
+        self.evictions = 0
+        # Players whose state changed since the last checkpoint (only kept when checkpointing)
+        self.track_dirty_players = track_dirty_players
+        self.dirty_players: set = set()
+        
+        # Optional cache of NPC replies; the key includes the last
+        # cache_history_window memory messages so replies stay in context
+        self.response_cache = response_cache
+        self.cache_history_window = cache_history_window
+        # Optional similarity-based cache consulted after an exact miss
+        self.semantic_cache = semantic_cache
+        
+        # "full" copies the memory window into every result; "delta" only
+        # writes the new turn and a (conversation_id, turn_index) reference,
+        # see npc_logs.py to rebuild full histories from a delta log
+        if history_mode not in ("full", "delta"):
+            raise ValueError(f"Unknown history mode: {history_mode}")
+        self.history_mode = history_mode
+        
+    def get_npc_prompt_template(self, npc_key: str, mood: Optional[NPCMood] = None) -> ChatPromptTemplate:
+        """Cached prompt for the NPC in the given mood (defaults to its current mood)"""
+        npc = self.npc_personalities[npc_key]
+        return self.prompt_templates.get(npc_key, mood or npc.mood)
+    
+    def update_npc_personality(self, npc_key: str, **changes):
+        """Edit an NPC's personality fields and rebuild its prompts on next use"""
+        npc = self.npc_personalities[npc_key]
+        for field, value in changes.items():
+            if not hasattr(npc, field):
+                raise AttributeError(f"NPCPersonality has no field '{field}'")
+            setattr(npc, field, value)
+        self.prompt_templates.invalidate(npc_key)
     
     def assign_npc_to_player(self, player_id: int) -> str:
         """Assign an NPC to a player (round-robin style)"""
-        if player_id not in self.player_npc_assignments:
-            npc_keys = list(self.npc_personalities.keys())
-            npc_key = npc_keys[player_id % len(npc_keys)]
-            self.player_npc_assignments[player_id] = npc_key
+        return self.get_player_state(player_id).npc_key
+    
+    def get_player_state(self, player_id: int) -> PlayerNPCState:
+        """Per-player NPC state, created with the NPC's starting mood on first contact.
         
-        return self.player_npc_assignments[player_id]
+        Only the state is created; the conversation is built by _ensure_player
+        on the player's first message. Evicted players are rehydrated.
+        """
+        state = self.player_states.get(player_id)
+        if state is None:
+            with self._players_lock:
+                state = self.player_states.get(player_id)
+                if state is None:
+                    if self.player_store is not None and player_id in self.player_store:
+                        state = self._ensure_player(player_id)[1]
+                    else:
+                        state = self._new_player_state(player_id)
+        return state
+    
+    def _new_player_state(self, player_id: int) -> PlayerNPCState:
+        npc_keys = list(self.npc_personalities.keys())
+        npc_key = npc_keys[player_id % len(npc_keys)]
+        state = PlayerNPCState(npc_key, self.npc_personalities[npc_key].mood)
+        self.player_states[player_id] = state
+        return state
+    
+    def _ensure_player(self, player_id: int, pin: bool = False):
+        """Hot (chain, state) of a player, rehydrated from the player store or created on first contact"""
+        with self._players_lock:
+            chain = self.player_conversations.get(player_id)
+            if chain is not None:
+                self.player_conversations.move_to_end(player_id)
+                self.hot_hits += 1
+                self.tracer.set_attributes(source="hot")
+            else:
+                data = self.player_store.pop(player_id) if self.player_store is not None else None
+                if data is not None:
+                    started = time.perf_counter()
+                    self.restore_player_state(player_id, data)
+                    elapsed = time.perf_counter() - started
+                    self.rehydrations += 1
+                    self.rehydrate_seconds += elapsed
+                    self.max_rehydrate_seconds = max(self.max_rehydrate_seconds, elapsed)
+                    self.tracer.set_attributes(source="rehydrated")
+                else:
+                    if player_id not in self.player_states:
+                        self._new_player_state(player_id)
+                    self.player_conversations[player_id] = self.create_conversation(player_id)
+                    self.new_players += 1
+                    self.tracer.set_attributes(source="new")
+                chain = self.player_conversations[player_id]
+            if pin:
+                self._in_flight[player_id] = self._in_flight.get(player_id, 0) + 1
+            self._evict_idle_players()
+            return chain, self.player_states[player_id]
+    
+    def _release_player(self, player_id: int):
+        with self._players_lock:
+            count = self._in_flight.pop(player_id) - 1
+            if count:
+                self._in_flight[player_id] = count
+            self._evict_idle_players()
+    
+    def _evict_idle_players(self):
+        """Move least recently used players without a turn in flight to the player store"""
+        if self.max_hot_players is None:
+            return
+        overflow = len(self.player_conversations) - self.max_hot_players
+        if overflow <= 0:
+            return
+        victims = []
+        for player_id in self.player_conversations:
+            if player_id not in self._in_flight:
+                victims.append(player_id)
+                if len(victims) == overflow:
+                    break
+        for player_id in victims:
+            self.player_store.put(player_id, self.export_player_state(player_id))
+            conversation = self.player_conversations.pop(player_id)
+            if isinstance(conversation, NativeConversationMemory):
+                conversation.clear()  # hand its texts back to the pool
+            del self.player_states[player_id]
+            self.evictions += 1
+    
+    def stash_player_state(self, player_id: int, data: Dict[str, Any]):
+        """Make saved player state available: in the player store when there is one, else rebuilt now"""
+        if self.player_store is not None:
+            self.player_store.put(player_id, data)
+        else:
+            self.restore_player_state(player_id, data)
+    
+    def player_stats(self) -> Dict[str, Any]:
+        with self._players_lock:
+            stats = {
+                'hot_players': len(self.player_conversations),
+                'max_hot_players': self.max_hot_players,
+                'hot_hits': self.hot_hits,
+                'new_players': self.new_players,
+                'rehydrations': self.rehydrations,
+                'evictions': self.evictions,
+                'mean_rehydrate_ms': (round(self.rehydrate_seconds / self.rehydrations * 1000, 3)
+                                      if self.rehydrations else 0.0),
+                'max_rehydrate_ms': round(self.max_rehydrate_seconds * 1000, 3),
+            }
+        if self.player_store is not None:
+            stats['store'] = self.player_store.stats()
+        return stats
     
     def create_conversation_chain(self, player_id: int) -> ConversationChain:
         npc_key = self.assign_npc_to_player(player_id)
         prompt = self.get_npc_prompt_template(npc_key)
         
-        memory = ConversationSummaryBufferMemory(
-            llm=self.llm,
-            max_token_limit=200,
-            return_messages=True
-        )
+        if self.summarizer is not None:
+            memory = BackgroundSummaryBufferMemory(
+                llm=self.llm,
+                max_token_limit=self.history_token_limit,
+                return_messages=True,
+                summarizer=self.summarizer,
+                token_counter=self.token_counter
+            )
+        else:
+            memory = ConversationSummaryBufferMemory(
+                llm=self.llm,
+                max_token_limit=self.history_token_limit,
+                return_messages=True
+            )
         
         chain = ConversationChain(
             llm=self.llm,
             prompt=prompt,
             memory=memory,
-            verbose=True
+            verbose=False
         )
         
         return chain
     
-    def update_npc_mood(self, player_id: int, message: str):
-        """Update NPC mood based on player message"""
-        npc_key = self.player_npc_assignments[player_id]
-        npc = self.npc_personalities[npc_key]
-        
-        message_lower = message.lower()
+    def create_conversation(self, player_id: int) -> Conversation:
+        """New conversation for a player in the configured memory mode"""
+        if self.memory_mode == "native":
+            return NativeConversationMemory(self.string_pool, self.memory_turns)
+        return self.create_conversation_chain(player_id)
+    
+    def _memory_messages(self, conversation: Conversation) -> List[Tuple[str, str]]:
+        """(role, content) of the messages in a conversation's memory window; role is 'human' or 'ai'"""
+        if isinstance(conversation, NativeConversationMemory):
+            messages = []
+            for player_text, npc_text in conversation.turns():
+                messages.append(("human", player_text))
+                messages.append(("ai", npc_text))
+            return messages
+        return [(msg.type, msg.content) for msg in conversation.memory.chat_memory.messages]
+    
+    def _memory_summary(self, conversation: Conversation) -> str:
+        if isinstance(conversation, NativeConversationMemory):
+            return conversation.summary
+        return getattr(conversation.memory, 'moving_summary_buffer', '')
+    
+    def export_player_state(self, player_id: int) -> Dict[str, Any]:
+        """JSON-serializable snapshot of a player's NPC state and conversation memory"""
+        with self._players_lock:
+            if player_id not in self.player_states:
+                # Evicted since it changed; the store has its latest state
+                return self.player_store.get(player_id)
+            return self._export_hot_player(player_id)
+    
+    def _export_hot_player(self, player_id: int) -> Dict[str, Any]:
+        state = self.player_states[player_id]
+        conversation = self.player_conversations[player_id]
+        if isinstance(conversation, NativeConversationMemory):
+            messages = []
+            for player_text, npc_text in conversation.turns():
+                messages.append(HumanMessage(content=player_text))
+                messages.append(AIMessage(content=npc_text))
+        else:
+            memory = conversation.memory
+            messages = list(memory.chat_memory.messages)
+            if isinstance(memory, BackgroundSummaryBufferMemory):
+                # Not summarized yet; they go back in front and are pruned again after restore
+                messages = memory.pending_messages() + messages
+        return {
+            'npc_key': state.npc_key,
+            'mood': state.mood.value,
+            'turns': state.turns,
+            'summary': self._memory_summary(conversation),
+            'messages': messages_to_dict(messages),
+        }
+    
+    def restore_player_state(self, player_id: int, data: Dict[str, Any]):
+        """Recreate a player's state and conversation from export_player_state output"""
+        state = PlayerNPCState(data['npc_key'], NPCMood(data['mood']))
+        state.turns = data['turns']
+        self.player_states[player_id] = state
         
-        if any(word in message_lower for word in ['stupid', 'useless', 'hate', 'idiot']):
-            npc.mood = NPCMood.ANGRY
-        elif any(word in message_lower for word in ['help', 'please', 'quest', 'thank']):
-            npc.mood = NPCMood.HELPFUL
-        elif any(word in message_lower for word in ['hello', 'hi', 'nice', 'good']):
-            npc.mood = NPCMood.FRIENDLY
-        elif any(word in message_lower for word in ['confused', 'lost', 'understand']):
-            npc.mood = NPCMood.CONFUSED
+        conversation = self.create_conversation(player_id)
+        messages = messages_from_dict(data['messages'])
+        if isinstance(conversation, NativeConversationMemory):
+            conversation.summary = data['summary']
+            for player_msg, npc_msg in zip(messages[::2], messages[1::2]):
+                conversation.add_turn(player_msg.content, npc_msg.content)
         else:
+            conversation.memory.moving_summary_buffer = data['summary']
+            conversation.memory.chat_memory.add_messages(messages)
+        self.player_conversations[player_id] = conversation
+    
+    def take_dirty_players(self) -> Dict[int, Dict[str, Any]]:
+        """Exported state of every player changed since the last call"""
+        dirty, self.dirty_players = self.dirty_players, set()
+        return {player_id: self.export_player_state(player_id) for player_id in dirty}
+    
+    def update_npc_mood(self, player_id: int, message: str):
+        """Update the NPC's mood towards this player based on their message"""
+        state = self.get_player_state(player_id)
+        
+        mood = self.mood_classifier.classify(message)
+        if mood is not None:
+            state.mood = NPCMood(mood)
+        elif state.mood == NPCMood.ANGRY:
             # Gradually return to neutral
-            if npc.mood == NPCMood.ANGRY:
-                npc.mood = NPCMood.NEUTRAL
+            state.mood = NPCMood.NEUTRAL
     
-    def process_message(self, player_id: int, message: str, timestamp: str) -> Dict[str, Any]:
-        # Create conversation chain if doesn't exist
-        if player_id not in self.player_conversations:
-            self.player_conversations[player_id] = self.create_conversation_chain(player_id)
+    def _prepare_turn(self, player_id: int, message: str):
+        """Get the player's chain ready for a new message and return (chain, state, npc, mood).
+        
+        The player stays pinned in memory until _release_player.
+        """
+        # Create (or rehydrate) the conversation chain if it isn't in memory
+        with self.tracer.span("memory_load"):
+            chain, state = self._ensure_player(player_id, pin=True)
         
         # Update mood
-        self.update_npc_mood(player_id, message)
+        started = time.perf_counter()
+        with self.tracer.span("mood_update") as span:
+            self.update_npc_mood(player_id, message)
+            span.set(mood=state.mood.value)
+        self.metrics.observe("mood_seconds", time.perf_counter() - started)
+        if self.track_dirty_players:
+            self.dirty_players.add(player_id)
         
-        # Generate response
-        chain = self.player_conversations[player_id]
-        npc_key = self.player_npc_assignments[player_id]
-        npc = self.npc_personalities[npc_key]
+        npc = self.npc_personalities[state.npc_key]
         
         # Update the prompt with current mood
-        chain.prompt = self.get_npc_prompt_template(npc_key)
+        self._apply_prompt(chain, state)
         
-        try:
-            response = chain.predict(input=message)
-        except Exception as e:
-            print(f"Error generating response: {e}")
-            response = f"*{npc.name} seems distracted and doesn't respond clearly*"
-        
-        # Get conversation history (last few messages)
-        conversation_history = []
-        if hasattr(chain.memory, 'chat_memory') and hasattr(chain.memory.chat_memory, 'messages'):
-            messages = chain.memory.chat_memory.messages[-6:]  # Last 3 exchanges
-            for i in range(0, len(messages), 2):
-                if i + 1 < len(messages):
-                    conversation_history.append({
-                        'player': messages[i].content if hasattr(messages[i], 'content') else str(messages[i]),
-                        'npc': messages[i+1].content if hasattr(messages[i+1], 'content') else str(messages[i+1])
-                    })
+        return chain, state, npc, state.mood
+    
+    def _apply_prompt(self, chain: Conversation, state: PlayerNPCState):
+        """Point a chain at the prompt for the player's current mood (native conversations format it per turn)"""
+        if isinstance(chain, ConversationChain):
+            # prompt_seconds is recorded here for chains and in _predict for native conversations
+            started = time.perf_counter()
+            with self.tracer.span("prompt_render"):
+                chain.prompt = self.get_npc_prompt_template(state.npc_key, state.mood)
+            self.metrics.observe("prompt_seconds", time.perf_counter() - started)
+    
+    def _cache_key(self, chain: Conversation, npc_key: str, mood: NPCMood, message: str) -> str:
+        history = self._memory_messages(chain)[-self.cache_history_window:] if self.cache_history_window else []
+        summary = self._memory_summary(chain)
+        if summary:
+            history.insert(0, ("summary", summary))
+        return make_cache_key(npc_key, mood.value, history, message)
+    
+    def _cached_response(self, chain: Conversation, npc_key: str, mood: NPCMood, message: str):
+        """Look the turn up in the exact, then the semantic cache; returns (response or None, exact key)"""
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self._cache_key(chain, npc_key, mood, message)
+            response = self.response_cache.get(cache_key)
+            if response is not None:
+                self.metrics.inc("cache_hits_total", cache="exact")
+                return response, cache_key
+            self.metrics.inc("cache_misses_total", cache="exact")
+        if self.semantic_cache is not None:
+            response = self.semantic_cache.get(npc_key, mood.value, message)
+            if response is not None:
+                self.metrics.inc("cache_hits_total", cache="semantic")
+                return response, cache_key
+            self.metrics.inc("cache_misses_total", cache="semantic")
+        return None, cache_key
+    
+    def _store_response(self, cache_key: Optional[str], npc_key: str, mood: NPCMood, message: str, response: str):
+        if cache_key is not None:
+            self.response_cache.put(cache_key, response)
+        if self.semantic_cache is not None:
+            self.semantic_cache.put(npc_key, mood.value, message, response)
+    
+    def _fixed_prompt_tokens(self, npc_key: str, mood: NPCMood) -> int:
+        """Tokens of the system prefix and the turn message around the player's input"""
+        counter = self.token_counter
+        # Both texts are the same objects every time, so their counts are cache hits
+        return (counter.count_message(self.prompt_templates.prefix(npc_key)) +
+                counter.count_message(self.prompt_templates.turn_templates[(npc_key, mood)]))
+    
+    def _native_prompt(self, conversation: NativeConversationMemory, npc_key: str, mood: NPCMood,
+                       message: str) -> List[BaseMessage]:
+        template = self.prompt_templates.get(npc_key, mood)
+        turns = None
+        if self.context_budget is not None:
+            budget = self.context_budget.history_budget(self._fixed_prompt_tokens(npc_key, mood), message)
+            turns = self.context_budget.select(conversation.turns(), budget)
+        return template.format_messages(history=conversation.history_messages(turns), input=message)
+    
+    def _predict(self, chain: Conversation, npc_key: str, npc: NPCPersonality, mood: NPCMood, message: str) -> str:
+        """Generate the NPC's reply.
         
-        return {
+        A chain records the turn in its memory itself; for native
+        conversations process_message adds it once the reply is in, so a
+        memory error is never mistaken for a failed model call.
+        """
+        self.prefix_reuse.record(self.prompt_templates.prefix(npc_key))
+        if isinstance(chain, NativeConversationMemory):
+            started = time.perf_counter()
+            with self.tracer.span("prompt_render"):
+                prompt = self._native_prompt(chain, npc_key, mood, message)
+            llm_started = time.perf_counter()
+            self.metrics.observe("prompt_seconds", llm_started - started)
+            with self.tracer.span("llm_request"):
+                response = self.llm.invoke(prompt).content
+            self.metrics.observe("llm_seconds", time.perf_counter() - llm_started)
+            return response
+        started = time.perf_counter()
+        # The chain renders its prompt and loads/saves memory around the call; all of it lands in this span
+        with self.tracer.span("llm_request"):
+            response = chain.predict(input=message)
+        self.metrics.observe("llm_seconds", time.perf_counter() - started)
+        return response
+    
+    async def _apredict(self, chain: Conversation, npc_key: str, npc: NPCPersonality, mood: NPCMood,
+                        message: str) -> str:
+        self.prefix_reuse.record(self.prompt_templates.prefix(npc_key))
+        if isinstance(chain, NativeConversationMemory):
+            started = time.perf_counter()
+            with self.tracer.span("prompt_render"):
+                prompt = self._native_prompt(chain, npc_key, mood, message)
+            llm_started = time.perf_counter()
+            self.metrics.observe("prompt_seconds", llm_started - started)
+            with self.tracer.span("llm_request"):
+                response = (await self.llm.ainvoke(prompt)).content
+            self.metrics.observe("llm_seconds", time.perf_counter() - llm_started)
+            return response
+        started = time.perf_counter()
+        # The chain renders its prompt and loads/saves memory around the call; all of it lands in this span
+        with self.tracer.span("llm_request"):
+            response = await chain.apredict(input=message)
+        self.metrics.observe("llm_seconds", time.perf_counter() - started)
+        return response
+    
+    def _record_turn(self, chain: Conversation, message: str, response: str):
+        """Add a turn answered from cache to memory"""
+        if isinstance(chain, NativeConversationMemory):
+            chain.add_turn(message, response)
+        else:
+            chain.memory.save_context({"input": message}, {"response": response})
+    
+    async def _arecord_turn(self, chain: Conversation, message: str, response: str):
+        if isinstance(chain, NativeConversationMemory):
+            chain.add_turn(message, response)
+        else:
+            await chain.memory.asave_context({"input": message}, {"response": response})
+    
+    def _conversation_history(self, chain: Conversation) -> List[Dict[str, str]]:
+        """The memory window as written to full-history logs"""
+        return [
+            {"player": content} if role == "human" else {"npc": content}
+            for role, content in self._memory_messages(chain)
+        ]
+    
+    def _build_result(self, chain: Conversation, state: PlayerNPCState, npc: NPCPersonality,
+                      mood: NPCMood, player_id: int, message: str, timestamp: str, response: str,
+                      recorded: bool) -> Dict[str, Any]:
+        """Result record for one turn; recorded is False when the turn never reached memory"""
+        result = {
             'timestamp': timestamp,
             'player_id': player_id,
             'player_message': message,
             'npc_name': npc.name,
             'npc_role': npc.role,
-            'npc_mood': npc.mood.value,
+            'npc_mood': mood.value,
             'npc_response': response.strip(),
-            #'conversation_history': str(chain.memory.buffer)
-            'conversation_history': [
-                {"player": msg.content} if msg.type == "human" else {"npc": msg.content}
-                for msg in chain.memory.chat_memory.messages
-            ]
+        }
+        
+        if self.history_mode == "delta":
+            result['conversation_id'] = conversation_id(player_id, state.npc_key)
+            # Failed turns never reach memory, so they get no place in the history
+            result['turn_index'] = state.turns if recorded else None
+        else:
+            #result['conversation_history'] = str(chain.memory.buffer)
+            result['conversation_history'] = self._conversation_history(chain)
+        
+        if recorded:
+            state.turns += 1
+        return result
+    
+    def process_message(self, player_id: int, message: str, timestamp: str) -> Dict[str, Any]:
+        """Answer one player message.
+        
+        The stages are separate methods so they can be timed on their own
+        (benchmarks/bench_stages.py): _ensure_player, update_npc_mood,
+        _apply_prompt, _cached_response, _predict, _conversation_history
+        and _build_result. With a tracer, the call is a span tagged with
+        player_id, npc_key and mood, with the stages as child spans.
+        """
+        with self.tracer.span("process_message", player_id=player_id) as span:
+            chain, state, npc, mood = self._prepare_turn(player_id, message)
+            span.set(npc_key=state.npc_key, mood=mood.value)
+            try:
+                npc_key = state.npc_key
+                recorded = True
+        
+                response, cache_key = self._cached_response(chain, npc_key, mood, message)
+        
+                if response is not None:
+                    # Cache hit: record the turn as if the model had answered
+                    span.set(cache_hit=True)
+                    self._record_turn(chain, message, response)
+                else:
+                    # Generate response
+                    try:
+                        response = self._predict(chain, npc_key, npc, mood, message)
+                    except Exception as e:
+                        print(f"Error generating response: {e}")
+                        self.metrics.inc("errors_total", type=type(e).__name__)
+                        self.metrics.inc("fallbacks_total")
+                        response = f"*{npc.name} seems distracted and doesn't respond clearly*"
+                        recorded = False
+                        span.set(fallback=True)
+                    else:
+                        if isinstance(chain, NativeConversationMemory):
+                            chain.add_turn(message, response)
+                        self._store_response(cache_key, npc_key, mood, message, response)
+        
+                return self._build_result(chain, state, npc, mood, player_id, message, timestamp, response, recorded)
+            finally:
+                self._release_player(player_id)
+    
+    async def aprocess_message(self, player_id: int, message: str, timestamp: str) -> Dict[str, Any]:
+        """Async variant of process_message.
+        
+        Callers must not run two messages of the same player at once; use
+        run_messages_async to get per-player ordering.
+        """
+        with self.tracer.span("process_message", player_id=player_id) as span:
+            chain, state, npc, mood = self._prepare_turn(player_id, message)
+            span.set(npc_key=state.npc_key, mood=mood.value)
+            try:
+                npc_key = state.npc_key
+                recorded = True
+        
+                response, cache_key = self._cached_response(chain, npc_key, mood, message)
+        
+                if response is not None:
+                    span.set(cache_hit=True)
+                    await self._arecord_turn(chain, message, response)
+                else:
+                    try:
+                        response = await self._apredict(chain, npc_key, npc, mood, message)
+                    except Exception as e:
+                        print(f"Error generating response: {e}")
+                        self.metrics.inc("errors_total", type=type(e).__name__)
+                        self.metrics.inc("fallbacks_total")
+                        response = f"*{npc.name} seems distracted and doesn't respond clearly*"
+                        recorded = False
+                        span.set(fallback=True)
+                    else:
+                        if isinstance(chain, NativeConversationMemory):
+                            chain.add_turn(message, response)
+                        self._store_response(cache_key, npc_key, mood, message, response)
+        
+                return self._build_result(chain, state, npc, mood, player_id, message, timestamp, response, recorded)
+            finally:
+                self._release_player(player_id)
+    
+    def close(self):
+        """Finish queued background summaries and stop the summarizer threads"""
+        if self.summarizer is not None:
+            self.summarizer.shutdown(wait=True)
+
+
+async def run_messages_async(system: EnhancedNPCSystem, messages: Iterable[PlayerMessage],
+                             on_result: Callable[[Dict[str, Any]], None],
+                             max_concurrency: Optional[int] = None) -> None:
+    """Process timestamp-sorted messages concurrently across players.
+    
+    Each player gets one task that walks its own messages in order, so a
+    player's ConversationChain always sees messages chronologically while
+    different players' LLM calls overlap. max_concurrency caps the number of
+    requests in flight (None means one per player).
+    """
+    by_player: Dict[int, List[PlayerMessage]] = {}
+    for msg in messages:
+        by_player.setdefault(msg.player_id, []).append(msg)
+    
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    
+    async def drain(player_messages: List[PlayerMessage]):
+        for msg in player_messages:
+            # One trace per message, covering the wait for the semaphore and on_result
+            with system.tracer.span("message", player_id=msg.player_id, timestamp=msg.timestamp):
+                if semaphore is None:
+                    result = await system.aprocess_message(msg.player_id, msg.text, msg.timestamp)
+                else:
+                    async with semaphore:
+                        result = await system.aprocess_message(msg.player_id, msg.text, msg.timestamp)
+                on_result(result)
+    
+    await asyncio.gather(*(drain(player_messages) for player_messages in by_player.values()))
+
+
+class LaneScheduler:
+    """Bounded worker pool where every player is pinned to one of N lanes.
+    
+    Each lane is a FIFO queue drained by its own worker thread, so a player's
+    messages are processed in submission (timestamp) order while players on
+    other lanes keep going. max_in_flight caps concurrent LLM requests across
+    all lanes; use more lanes than that to keep a slow player from holding up
+    the few players that share its lane.
+    
+    A message that raises is counted against its lane and the lane moves
+    on to the next one; close() re-raises the first such error once all
+    lanes have drained, so a failing run cannot pass for a complete one.
+    """
+    
+    def __init__(self, system: EnhancedNPCSystem, on_result: Callable[[Dict[str, Any]], None],
+                 lanes: int = 4, max_in_flight: Optional[int] = None, queue_size: int = 0):
+        if lanes < 1:
+            raise ValueError("LaneScheduler needs at least one lane")
+        self.system = system
+        self.on_result = on_result
+        self.lanes = lanes
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(lanes)]
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.result_lock = threading.Lock()
+        
+        # Counters, indexed by lane
+        self.enqueued = [0] * lanes
+        self.processed = [0] * lanes
+        self.max_depth = [0] * lanes
+        self.busy_seconds = [0.0] * lanes
+        self.throttled_seconds = [0.0] * lanes  # waiting on max_in_flight
+        self.errors = [0] * lanes
+        self.first_error: Optional[BaseException] = None
+        
+        self.workers: List[threading.Thread] = []
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+    
+    def lane_for(self, player_id: int) -> int:
+        """Stable player -> lane mapping (same lane across runs and processes)"""
+        return zlib.crc32(str(player_id).encode()) % self.lanes
+    
+    def start(self):
+        self.started_at = time.perf_counter()
+        for lane in range(self.lanes):
+            worker = threading.Thread(target=self._run_lane, args=(lane,), name=f"npc-lane-{lane}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def submit(self, msg: PlayerMessage):
+        """Queue a message; blocks when the lane is full and queue_size is set"""
+        lane = self.lane_for(msg.player_id)
+        self.queues[lane].put(msg)
+        self.enqueued[lane] += 1
+        self.max_depth[lane] = max(self.max_depth[lane], self.queues[lane].qsize())
+    
+    def close(self):
+        """Wait for all queued messages to finish and stop the workers; raises the first message error"""
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.stopped_at = time.perf_counter()
+        if self.first_error is not None:
+            raise self.first_error
+    
+    def _run_lane(self, lane: int):
+        q = self.queues[lane]
+        while True:
+            msg = q.get()
+            if msg is None:
+                break
+            
+            try:
+                self._run_message(lane, msg)
+            except Exception as e:
+                # Keep the lane alive; later messages of its players still get processed
+                print(f"Error processing message from Player {msg.player_id} on lane {lane}: {e}")
+                with self.result_lock:
+                    self.errors[lane] += 1
+                    if self.first_error is None:
+                        self.first_error = e
+    
+    def _run_message(self, lane: int, msg: PlayerMessage):
+        with self.system.tracer.span("message", player_id=msg.player_id, timestamp=msg.timestamp, lane=lane):
+            if self.in_flight is None:
+                started = time.perf_counter()
+                result = self.system.process_message(msg.player_id, msg.text, msg.timestamp)
+            else:
+                waited = time.perf_counter()
+                with self.in_flight:
+                    started = time.perf_counter()
+                    self.throttled_seconds[lane] += started - waited
+                    result = self.system.process_message(msg.player_id, msg.text, msg.timestamp)
+            self.busy_seconds[lane] += time.perf_counter() - started
+            self.processed[lane] += 1
+            
+            with self.result_lock:
+                self.on_result(result)
+    
+    def gauges(self) -> Dict[str, float]:
+        """Current lane stats as metrics collector gauges, readable while the run is going"""
+        stats = self.stats()
+        gauges = {f"lanes_{key}": stats[key] for key in ("processed", "errors", "queue_depth", "mean_utilization")}
+        for lane in stats['per_lane']:
+            for key in ("queue_depth", "max_queue_depth", "processed", "errors", "utilization"):
+                gauges[f'lane_{key}{{lane="{lane["lane"]}"}}'] = lane[key]
+        return gauges
+    
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and utilization per lane, for sizing lanes against rate limits"""
+        end = self.stopped_at if self.stopped_at is not None else time.perf_counter()
+        elapsed = end - self.started_at if self.started_at is not None else 0.0
+        lanes = []
+        for lane in range(self.lanes):
+            lanes.append({
+                'lane': lane,
+                'queue_depth': self.queues[lane].qsize(),
+                'max_queue_depth': self.max_depth[lane],
+                'enqueued': self.enqueued[lane],
+                'processed': self.processed[lane],
+                'errors': self.errors[lane],
+                'busy_seconds': round(self.busy_seconds[lane], 3),
+                'throttled_seconds': round(self.throttled_seconds[lane], 3),
+                'utilization': round(self.busy_seconds[lane] / elapsed, 3) if elapsed else 0.0,
+            })
+        return {
+            'lanes': self.lanes,
+            'elapsed_seconds': round(elapsed, 3),
+            'processed': sum(self.processed),
+            'errors': sum(self.errors),
+            'queue_depth': sum(lane['queue_depth'] for lane in lanes),
+            'mean_utilization': round(sum(lane['utilization'] for lane in lanes) / self.lanes, 3),
+            'per_lane': lanes,
         }
 
 # -----------------------------
 # Runner: process players.json
 # -----------------------------
+def print_result(result: Dict[str, Any]):
+    # One write per result instead of four
+    print(f"Player {result['player_id']}: {result['player_message']}\n"
+          f"→ {result['npc_name']} ({result['npc_role']}, {result['npc_mood']}): {result['npc_response']}\n"
+          f"Time: {result['timestamp']}\n"
+          + "-" * 40)
+
+def should_echo(mode: str, count: int, every: int) -> bool:
+    """Whether the count-th result (1-based) goes to the console under --echo"""
+    if mode == "all":
+        return True
+    if mode == "sample":
+        return (count - 1) % every == 0
+    return False
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Replay a players.json feed through the NPC system")
+    parser.add_argument("--input", default="players.json",
+                        help="Player messages as a JSON array or ndjson ('-' reads stdin)")
+    parser.add_argument("--order", choices=["memory", "external", "watermark", "none"], default="memory",
+                        help="memory: load and sort the whole feed by timestamp; "
+                             "external: sort with bounded memory by spilling sorted runs to temp files; "
+                             "watermark: reorder a live stream within --lateness seconds; "
+                             "none: stream it in file order with constant memory (feed must be pre-sorted)")
+    parser.add_argument("--run-size", type=int, default=100000,
+                        help="Messages held in memory per sorted run in external order")
+    parser.add_argument("--tmp-dir", default=None, help="Directory for external sort runs")
+    parser.add_argument("--lateness", type=float, default=10.0,
+                        help="Seconds a message may arrive behind the newest one in watermark order")
+    parser.add_argument("--reorder-buffer", type=int, default=None,
+                        help="Max messages held for reordering in watermark order")
+    parser.add_argument("--drop-late", action="store_true",
+                        help="Drop messages arriving behind the watermark instead of processing them out of order")
+    parser.add_argument("--log", default="logs/run.jsonl", help="File results are written to")
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default=None,
+                        help="Log format; by default taken from the --log extension (.jsonl, .gz, .zst, .npz, .parquet)")
+    parser.add_argument("--mode", choices=["serial", "async", "lanes"], default="serial",
+                        help="serial: one message at a time; async: players run concurrently; "
+                             "lanes: players hashed onto worker threads. "
+                             "Each player's messages always stay in timestamp order")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Max LLM requests in flight in async/lanes mode (default: unbounded)")
+    parser.add_argument("--lanes", type=int, default=4, help="Number of worker lanes in lanes mode")
+    parser.add_argument("--lane-queue-size", type=int, default=1000,
+                        help="Messages queued per lane before reading the feed blocks (0: unbounded)")
+    parser.add_argument("--cache", choices=["none", "memory", "sqlite"], default="none",
+                        help="Exact-match response cache backend")
+    parser.add_argument("--cache-path", default="logs/response_cache.sqlite3", help="SQLite cache file")
+    parser.add_argument("--cache-size", type=int, default=10000, help="Max cached responses")
+    parser.add_argument("--cache-ttl", type=float, default=None, help="Cache entry lifetime in seconds")
+    parser.add_argument("--summaries", choices=["background", "inline"], default="background",
+                        help="Run memory summarization in background threads or inline on the request path")
+    parser.add_argument("--semantic-threshold", type=float, default=None,
+                        help="Enable the semantic cache, serving replies at or above this cosine similarity")
+    parser.add_argument("--history", choices=["full", "delta"], default="full",
+                        help="Log the memory window with every result, or only the new turn plus a reference")
+    parser.add_argument("--echo", choices=["all", "sample", "none"], default="all",
+                        help="Print every result to the console, every --echo-every-th one, or none")
+    parser.add_argument("--echo-every", type=int, default=100, help="Sampling interval for --echo sample")
+    parser.add_argument("--flush-bytes", type=int, default=1 << 20,
+                        help="Write the log out once this many bytes are buffered")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="Write the log out at least this often, in seconds")
+    parser.add_argument("--memory", choices=["langchain", "native"], default="langchain",
+                        help="Per-player ConversationChain with summary memory, or the lightweight native memory")
+    parser.add_argument("--memory-turns", type=int, default=6,
+                        help="Turns kept verbatim by the native memory (at least 1)")
+    parser.add_argument("--prompt-tokens", type=int, default=None,
+                        help="Token budget for the prompt; history is trimmed to fit (default: fixed 200-token memory)")
+    parser.add_argument("--tokenizer-vocab", default=None,
+                        help="Local cl100k-style .tiktoken vocabulary for offline token counting")
+    parser.add_argument("--max-hot-players", type=int, default=None,
+                        help="Keep at most this many players' chains in memory; idle ones go to --player-store")
+    parser.add_argument("--player-store", default="logs/player_state.sqlite3",
+                        help="SQLite file holding the state of evicted players")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file for the input position and per-player state (serial mode)")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="Messages between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue from --checkpoint: rehydrate players and skip messages already logged")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics (0 picks a free port)")
+    parser.add_argument("--metrics-file", default=None,
+                        help="Rewrite this file with the metrics every --metrics-interval seconds")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between --metrics-file dumps")
+    parser.add_argument("--trace-file", default=None,
+                        help="Append a trace per message (spans for memory load, mood, prompt, LLM call, log write) "
+                             "to this JSONL file")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0,
+                        help="Share of messages traced with --trace-file, e.g. 0.01 to leave tracing on in production")
+    add_backend_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.checkpoint and args.mode != "serial":
+        parser.error("--checkpoint only supports --mode serial")
+    if args.checkpoint and (args.log_format or log_format_for_path(args.log)) != "jsonl":
+        parser.error("--checkpoint needs an uncompressed JSONL --log")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if args.lane_queue_size < 0:
+        parser.error("--lane-queue-size must be 0 (unbounded) or more")
+    if args.memory_turns < 1:
+        parser.error("--memory-turns must be at least 1")
+    if not 0.0 <= args.trace_sample_rate <= 1.0:
+        parser.error("--trace-sample-rate must be between 0 and 1")
+    return args
+
 # Usage example
-def main():
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+
     # Load .env file
     load_dotenv()
 
-    # Load API key from env
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
+    # Load API key from env; the mock, fake and --base-url servers take a placeholder
+    if not os.getenv("OPENAI_API_KEY") and args.backend == "openai" and not args.base_url:
         raise ValueError("Please set OPENAI_API_KEY in your environment or .env file")
     
-    system = EnhancedNPCSystem(api_key)
-
-    json_filename = "players.json"
+    backend = backend_from_args(args)
+    api_key = backend.api_key(os.getenv("OPENAI_API_KEY"))
+    if backend.base_url:
+        print(f"LLM backend: {backend.kind} at {backend.base_url}")
+    
+    # Metrics are only recorded when something reads them
+    metrics = Metrics() if args.metrics_port is not None or args.metrics_file else None
+    metrics_server = metrics_dumper = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(metrics, port=args.metrics_port).start()
+        print(f"Metrics: {metrics_server.url}")
+    if args.metrics_file:
+        metrics_dumper = MetricsDumper(metrics, args.metrics_file, args.metrics_interval).start()
+    tracer = Tracer(JsonlSpanExporter(args.trace_file), args.trace_sample_rate) if args.trace_file else None
+    
+    response_cache = create_response_cache(args.cache, path=args.cache_path, max_entries=args.cache_size,
+                                           ttl_seconds=args.cache_ttl)
+    semantic_cache = SemanticResponseCache(args.semantic_threshold) if args.semantic_threshold is not None else None
+    player_store = None
+    if args.max_hot_players is not None:
+        # Evicted state only lives for one run; checkpoints are what survives a restart
+        player_store = SQLitePlayerStore(args.player_store)
+        player_store.clear()
+    system = EnhancedNPCSystem(api_key, response_cache=response_cache, semantic_cache=semantic_cache,
+                               summary_mode=args.summaries, history_mode=args.history,
+                               player_store=player_store, max_hot_players=args.max_hot_players,
+                               track_dirty_players=bool(args.checkpoint), memory_mode=args.memory,
+                               memory_turns=args.memory_turns, prompt_tokens=args.prompt_tokens,
+                               tokenizer_vocab=args.tokenizer_vocab, backend=backend, metrics=metrics,
+                               tracer=tracer)
 
-    # Load players.json
-    try:
-        with open(json_filename, "r") as f:
-            messages = json.load(f)
-    except FileNotFoundError:
+    json_filename = args.input
+    if json_filename != "-" and not os.path.exists(json_filename):
         print(f"Could not find {json_filename}.")
-        
+        return
+    
+    checkpoint_store = None
+    checkpoint = None
+    checkpoint_meta = {'input': args.input, 'order': args.order, 'log': args.log}
+    if args.checkpoint:
+        checkpoint_store = CheckpointStore(args.checkpoint)
+        if args.resume:
+            checkpoint = checkpoint_store.load()
+            if checkpoint is None:
+                print(f"No checkpoint in {args.checkpoint}, starting from the beginning")
+            elif checkpoint['meta'] != checkpoint_meta:
+                print(f"Checkpoint {args.checkpoint} belongs to another run: {checkpoint['meta']}")
+                return
+            else:
+                for player_id, data in checkpoint['players'].items():
+                    system.stash_player_state(player_id, data)
+                print(f"Resuming after message {checkpoint['cursor']} with {len(checkpoint['players'])} players")
+        if checkpoint is None:
+            checkpoint_store.reset()
 
-    # Sort by timestamp
-    messages.sort(key=lambda x: datetime.fromisoformat(x["timestamp"]))
+    # Stream players.json; records are parsed one at a time
+    ingest_stats = IngestStats()
+    messages = iter_messages(json_filename, ingest_stats)
+    
+    sort_stats = None
+    reorder_buffer = None
+    if args.order == "memory":
+        # Sort by timestamp
+        messages = sort_messages(messages)
+    elif args.order == "external":
+        sort_stats = SortStats()
+        messages = external_sort(messages, run_size=args.run_size, tmp_dir=args.tmp_dir, stats=sort_stats)
+    elif args.order == "watermark":
+        reorder_buffer = WatermarkReorderBuffer(args.lateness, max_buffer=args.reorder_buffer,
+                                                late_policy="drop" if args.drop_late else "emit")
+        messages = reorder_stream(messages, reorder_buffer)
+    if args.mode == "async" and not isinstance(messages, list):
+        # The async runner groups the whole feed by player up front
+        messages = list(messages)
+    total = len(messages) if isinstance(messages, list) else None
 
-    # Create logs directory
-    os.makedirs("logs", exist_ok=True)
-    log_file = "logs/run.jsonl"
+    # Creates the logs directory; JSONL records are written out in batches by a background thread
+    log_file = args.log
+    log_options = {'flush_bytes': args.flush_bytes, 'flush_interval': args.flush_interval}
+    if checkpoint is not None:
+        # Records written after the checkpoint are produced again below
+        log_options['truncate_to'] = checkpoint['log_offset']
+    log = create_log_writer(log_file, args.log_format, **log_options)
+    if metrics is not None:
+        metrics.add_collector(lambda: {f"log_{key}": value for key, value in log.stats().items()
+                                       if key in ("records", "bytes_written", "flushes", "file_bytes")})
+        if reorder_buffer is not None:
+            # Late arrivals and buffer depth of a stream that may never end
+            metrics.add_collector(lambda: {f"reorder_{key}": value for key, value in reorder_buffer.stats().items()
+                                           if key != "watermark"})
 
-    print(f"Processing {len(messages)} messages...")
+    print(f"Processing {total if total is not None else 'streamed'} messages ({args.mode} mode)...")
     print("=" * 60)
     
+    echo_lock = threading.Lock()
+    echoed = [0]
+    
+    def on_result(result: Dict[str, Any]):
+        started = time.perf_counter()
+        with system.tracer.span("log_write"):
+            log.write(result)
+        system.metrics.observe("log_write_seconds", time.perf_counter() - started)
+        with echo_lock:
+            echoed[0] += 1
+            if should_echo(args.echo, echoed[0], args.echo_every):
+                print_result(result)
+    
+    def save_checkpoint(cursor: int):
+        # The log has to be on disk up to cursor before the checkpoint says so
+        checkpoint_store.save(cursor, log.sync(), system.take_dirty_players(), checkpoint_meta)
+    
     try:
-        with open(log_file, "w") as log:
-            for i, msg in enumerate(messages, 1):
-                print(f"[{i}/{len(messages)}] Processing message from Player {msg['player_id']}...")
-                
-                result = system.process_message(
-                    player_id=msg["player_id"],
-                    message=msg["text"],
-                    timestamp=msg["timestamp"]
-                )
+        with log:
+            
+            if args.mode == "async":
+                asyncio.run(run_messages_async(system, messages, on_result, args.concurrency))
+            elif args.mode == "lanes":
+                scheduler = LaneScheduler(system, on_result, lanes=args.lanes, max_in_flight=args.concurrency,
+                                          queue_size=args.lane_queue_size)
+                if metrics is not None:
+                    metrics.add_collector(scheduler.gauges)
+                scheduler.start()
+                for msg in messages:
+                    scheduler.submit(msg)
+                try:
+                    scheduler.close()
+                finally:
+                    stats = scheduler.stats()
+                    print(f"Lanes: {stats['lanes']}, mean utilization {stats['mean_utilization']:.0%}, "
+                          f"{stats['errors']} failed messages")
+                    for lane in stats['per_lane']:
+                        print(f"  lane {lane['lane']}: {lane['processed']} messages ({lane['errors']} failed), "
+                              f"max queue depth {lane['max_queue_depth']}, utilization {lane['utilization']:.0%}")
+            else:
+                # Messages before the checkpoint are still parsed (and sorted), just not processed
+                start = checkpoint['cursor'] if checkpoint is not None else 0
+                i = start
+                for i, msg in enumerate(itertools.islice(messages, start, None), start + 1):
+                    if should_echo(args.echo, i, args.echo_every):
+                        progress = f"{i}/{total}" if total is not None else str(i)
+                        print(f"[{progress}] Processing message from Player {msg.player_id}...")
+                    
+                    with system.tracer.span("message", player_id=msg.player_id, timestamp=msg.timestamp):
+                        result = system.process_message(
+                            player_id=msg.player_id,
+                            message=msg.text,
+                            timestamp=msg.timestamp
+                        )
+                        
+                        # Buffer for the log file and print to console
+                        on_result(result)
+                    
+                    if checkpoint_store is not None and i % args.checkpoint_every == 0:
+                        save_checkpoint(i)
                 
-                # Write to log file
-                log.write(json.dumps(result) + "\n")
-                
-                # Print to console
-                print(f"Player {result['player_id']}: {result['player_message']}")
-                print(f"→ {result['npc_name']} ({result['npc_role']}, {result['npc_mood']}): {result['npc_response']}")
-                print(f"Time: {result['timestamp']}")
-                print("-" * 40)
+                if checkpoint_store is not None:
+                    save_checkpoint(i)
                 
         print(f"\nProcessing complete! Logs saved to {log_file}")
         
     except Exception as e:
         print(f"Error during processing: {e}")
         print("Make sure your OpenAI API key is valid and you have sufficient credits.")
+    
+    stats = log.stats()
+    if 'flushes' in stats:
+        print(f"Log writer ({stats['format']}, {stats['encoder']}): {stats['records']} records, "
+              f"{stats['bytes_written']} bytes in {stats['flushes']} flushes ({stats['file_bytes']} on disk), "
+              f"{stats['bytes_per_second']} bytes/s, "
+              f"flush latency mean {stats['mean_flush_ms']}ms / max {stats['max_flush_ms']}ms")
+    else:
+        print(f"Log writer ({stats['format']}): {stats['records']} records, {stats['file_bytes']} bytes, "
+              f"{stats['records_per_second']} records/s")
+    
+    if checkpoint_store is not None:
+        checkpoint_store.close()
+        stats = checkpoint_store.stats()
+        print(f"Checkpoints: {stats['saves']} saves, {stats['mean_players_per_save']} players per save, "
+              f"{stats['bytes_written']} bytes, {stats['compactions']} compactions")
+    
+    stats = ingest_stats.stats()
+    print(f"Ingested {stats['messages']} messages ({stats['bytes_read']} bytes) in {stats['parse_seconds']}s "
+          f"of parsing: {stats['messages_per_second']:.0f} messages/s")
+    if sort_stats is not None:
+        stats = sort_stats.stats()
+        print(f"External sort: {stats['runs']} runs spilled ({stats['spilled_bytes']} bytes), "
+              f"{stats['merge_passes']} merge passes")
+    if reorder_buffer is not None:
+        stats = reorder_buffer.stats()
+        print(f"Reorder buffer: {stats['late']} late arrivals ({stats['dropped']} dropped), "
+              f"max depth {stats['max_buffer_depth']}, {stats['forced_releases']} forced releases, "
+              f"max observed lateness {stats['max_observed_lateness_seconds']}s")
+    
+    system.close()
+    if system.summarizer is not None:
+        stats = system.summarizer.stats()
+        print(f"Summaries: {stats['deferred']} deferred off the request path, {stats['coalesced']} coalesced, "
+              f"{stats['completed']} completed, {stats['failed']} failed")
+
+    if backend.server is not None:
+        stats = backend.server.stats()
+        print(f"Mock LLM: {stats['requests']} requests ({stats['errors']} failed), "
+              f"{stats['prompt_tokens']} prompt / {stats['completion_tokens']} completion tokens, "
+              f"delay mean {stats['mean_delay_ms']}ms / max {stats['max_delay_ms']}ms")
+    backend.close()
+
+    if system.context_budget is not None:
+        stats = system.token_counter.stats()
+        budget = system.context_budget.stats()
+        if system.memory_mode == "native":
+            packing = (f"packed {budget['turns_packed']}/{budget['turns_offered']} history turns, "
+                       f"{budget['over_budget']} prompts over budget")
+        else:
+            packing = f"memory limit {system.history_token_limit} tokens"
+        print(f"Tokens ({stats['tokenizer']}): {stats['hits']} cached counts, {stats['misses']} tokenized; "
+              f"prompt budget {budget['prompt_tokens']}, {packing}")
+
+    stats = system.prefix_reuse.stats()
+    if stats['calls']:
+        print(f"Prompt prefixes: {stats['reused']}/{stats['calls']} LLM calls reused a system prefix "
+              f"({stats['reuse_ratio']:.0%}, {stats['distinct_prefixes']} distinct), "
+              f"~{stats['tokens_saved']} of {stats['prefix_tokens']} prefix tokens cacheable by the provider")
+
+    if player_store is not None:
+        stats = system.player_stats()
+        print(f"Players: {stats['hot_players']} hot (cap {stats['max_hot_players']}), {stats['hot_hits']} hot hits, "
+              f"{stats['new_players']} new, {stats['evictions']} evictions, {stats['rehydrations']} rehydrations "
+              f"(mean {stats['mean_rehydrate_ms']}ms, max {stats['max_rehydrate_ms']}ms), "
+              f"{stats['store']['cold_players']} in the store")
+        player_store.close()
+    
+    if response_cache is not None:
+        stats = response_cache.stats()
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%}), {stats['evictions']} evictions, {stats['expirations']} expired")
+        response_cache.close()
+    if semantic_cache is not None:
+        stats = semantic_cache.stats()
+        print(f"Semantic cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+              f"threshold {stats['threshold']}, mean hit similarity {stats['mean_hit_similarity']}")
+        print(f"  similarity histogram (0.05 buckets): {stats['similarity_histogram']}")
+    
+    if metrics is not None:
+        if metrics_dumper is not None:
+            metrics_dumper.close()
+            print(f"Metrics written to {args.metrics_file} ({metrics_dumper.dumps} dumps)")
+        if metrics_server is not None:
+            metrics_server.close()
+        report = metrics.snapshot()
+        for name in ("llm_seconds", "mood_seconds", "prompt_seconds", "summarize_seconds", "log_write_seconds"):
+            if name in report:
+                stats = report[name]
+                print(f"  {name}: {stats['count']} observed, p50 {stats['p50_ms']}ms, "
+                      f"p99 {stats['p99_ms']}ms, max {stats['max_ms']}ms")
+    
+    if tracer is not None:
+        tracer.close()
+        stats = tracer.stats()
+        print(f"Traces: {stats['sampled']}/{stats['traces']} messages sampled (rate {stats['sample_rate']}), "
+              f"{stats['exported_spans']} spans appended to {stats['path']}")
 
     
     # Process a sample message
@@ -1,13 +1,21 @@
+import argparse
 import json
 import os
-from datetime import datetime
-from typing import List, Dict, Any
+import sys
+from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
 from enum import Enum
-import openai
 from collections import defaultdict, deque
 from dotenv import load_dotenv
 
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from npc_backend import LLMBackend, add_backend_arguments, backend_from_args
+from npc_ingest import PlayerMessage, iter_messages, sort_messages
+from npc_logs import create_log_writer
+from npc_mood import MoodClassifier, MoodRule
+from npc_tokens import TokenCounter, pack_turns
+
 
 class NPCMood(Enum):
     NEUTRAL = "neutral"
@@ -16,91 +24,99 @@ class NPCMood(Enum):
     HELPFUL = "helpful"
     CONFUSED = "confused"
 
-@dataclass
-class PlayerMessage:
-    player_id: int
-    text: str
-    timestamp: datetime
-    
-    @classmethod
-    def from_dict(cls, data: Dict[str, Any]) -> 'PlayerMessage':
-        return cls(
-            player_id=data['player_id'],
-            text=data['text'],
-            timestamp=datetime.fromisoformat(data['timestamp'])
-        )
-
 @dataclass
 class NPCState:
     mood: NPCMood = NPCMood.NEUTRAL
     conversation_history: deque = None
+    history_size: int = 3
     
     def __post_init__(self):
         if self.conversation_history is None:
-            self.conversation_history = deque(maxlen=3)
+            self.conversation_history = deque(maxlen=self.history_size)
+
+# Checked together; on overlap angry beats helpful beats friendly
+MOOD_RULES = [
+    MoodRule(NPCMood.ANGRY.value, ['stupid*', 'useless', 'idiot*', 'hate*', 'suck*', 'terrible', 'awful', 'damn*'],
+             priority=3),
+    MoodRule(NPCMood.HELPFUL.value, ['where', 'how', 'what', 'quest', 'quests', 'direction*', 'guide*', 'help*'],
+             priority=2),
+    MoodRule(NPCMood.FRIENDLY.value, ['hello', 'hi', 'thank you', 'thanks', 'please', 'help*', 'quest', 'village*',
+                                      'nice'], priority=1),
+]
 
 class NPCChatSystem:
-    def __init__(self, api_key: str = None):
+    def __init__(self, api_key: str = None, context_tokens: Optional[int] = None, history_size: int = 3,
+                 backend: Optional[LLMBackend] = None):
         """
         Initialize the NPC Chat System
         
         Args:
             api_key: OpenAI API key. If None, will try to get from environment
+            context_tokens: Token budget for the user message (history plus the
+                current message). When set, as many of the last history_size
+                player messages as fit are included, newest first.
+            history_size: Player messages remembered per player
+            backend: Where requests go (default: the OpenAI API)
         """
-        if api_key:
-            openai.api_key = api_key
-        else:
-            #openai.api_key = os.getenv('OPENAI_API_KEY')
+        backend = backend or LLMBackend()
+        if not api_key:
             load_dotenv()
+            api_key = os.getenv('OPENAI_API_KEY')
+        api_key = backend.api_key(api_key)
             
-        if not openai.api_key:
+        if not api_key:
             raise ValueError("OpenAI API key not found. Please set OPENAI_API_KEY environment variable or pass it directly.")
+        self.client = backend.client(api_key)
         
         # Track NPC state per player
-        self.player_states: Dict[int, NPCState] = defaultdict(NPCState)
+        self.player_states: Dict[int, NPCState] = defaultdict(lambda: NPCState(history_size=history_size))
+        
+        self.context_tokens = context_tokens
+        self.token_counter = TokenCounter() if context_tokens is not None else None
         
         # Store all processed interactions for logging
         self.interaction_logs: List[Dict[str, Any]] = []
         
+        self.mood_classifier = MoodClassifier(MOOD_RULES)
+        
     def analyze_mood_from_message(self, message_text: str, current_mood: NPCMood) -> NPCMood:
         """
         Analyze the player's message to determine NPC mood change
         """
-        message_lower = message_text.lower()
-        
-        # Mood triggers
-        friendly_triggers = ['hello', 'hi', 'thank you', 'thanks', 'please', 'help', 'quest', 'village', 'nice']
-        angry_triggers = ['stupid', 'useless', 'idiot', 'hate', 'suck', 'terrible', 'awful', 'damn']
-        helpful_triggers = ['where', 'how', 'what', 'quest', 'direction', 'guide', 'help']
-        
-        # Check for mood changes
-        if any(trigger in message_lower for trigger in angry_triggers):
-            return NPCMood.ANGRY
-        elif any(trigger in message_lower for trigger in helpful_triggers):
-            return NPCMood.HELPFUL
-        elif any(trigger in message_lower for trigger in friendly_triggers):
-            return NPCMood.FRIENDLY
-        else:
-            # Gradually return to neutral if no strong triggers
-            if current_mood == NPCMood.ANGRY:
-                return NPCMood.NEUTRAL
-            return current_mood
+        mood = self.mood_classifier.classify(message_text)
+        if mood is not None:
+            return NPCMood(mood)
+        
+        # Gradually return to neutral if no strong triggers
+        if current_mood == NPCMood.ANGRY:
+            return NPCMood.NEUTRAL
+        return current_mood
     
     def build_conversation_context(self, player_id: int, current_message: str) -> str:
         """
-        Build conversation context from the last 3 messages
+        Build conversation context from the last messages (all of them, or
+        as many as fit context_tokens)
         """
         state = self.player_states[player_id]
         context_parts = []
+        current = f"Current message: {current_message}"
+        
+        history = list(state.conversation_history)
+        if self.token_counter is not None and history:
+            # Line counts are cached per text, so older messages are never re-tokenized
+            count = self.token_counter.count
+            budget = self.context_tokens - count(current) - count("Recent conversation:")
+            costs = [count(f"1. Player: {msg}") for msg in history]
+            history = history[len(history) - pack_turns(costs, max(budget, 0)):]
         
         # Add conversation history
-        if state.conversation_history:
+        if history:
             context_parts.append("Recent conversation:")
-            for i, msg in enumerate(state.conversation_history, 1):
+            for i, msg in enumerate(history, 1):
                 context_parts.append(f"{i}. Player: {msg}")
         
         # Add current message
-        context_parts.append(f"Current message: {current_message}")
+        context_parts.append(current)
         
         return "\n".join(context_parts)
     
@@ -133,7 +149,7 @@ Current mood: {state.mood.value}
 """
         
         try:
-            response = openai.chat.completions.create(
+            response = self.client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -176,7 +192,7 @@ Current mood: {state.mood.value}
             'npc_reply': npc_reply,
             'conversation_state': conversation_state,
             'npc_mood': state.mood.value,
-            'timestamp': message.timestamp.isoformat()
+            'timestamp': message.timestamp
         }
         
         self.interaction_logs.append(interaction)
@@ -186,15 +202,11 @@ Current mood: {state.mood.value}
         """
         Process all messages from a JSON file in chronological order
         """
-        # Load messages from file
-        with open(filename, 'r') as f:
-            messages_data = json.load(f)
-        
-        # Convert to PlayerMessage objects
-        messages = [PlayerMessage.from_dict(msg_data) for msg_data in messages_data]
+        # Load messages from file as PlayerMessage records
+        messages = iter_messages(filename)
         
         # Sort by timestamp to ensure chronological processing
-        messages.sort(key=lambda x: x.timestamp)
+        messages = sort_messages(messages)
         
         print(f"Processing {len(messages)} messages in chronological order...")
         print("-" * 80)
@@ -219,10 +231,17 @@ Current mood: {state.mood.value}
     
     def save_logs_to_file(self, filename: str = "npc_chat_logs.json") -> None:
         """
-        Save all interaction logs to a JSON file
+        Save all interaction logs to a file. A .json name writes one
+        indented JSON document; .jsonl, .gz, .zst, .npz and .parquet go
+        through the matching npc_logs writer.
         """
-        with open(filename, 'w') as f:
-            json.dump(self.interaction_logs, f, indent=2)
+        if filename.endswith(".json"):
+            with open(filename, 'w') as f:
+                json.dump(self.interaction_logs, f, indent=2)
+        else:
+            with create_log_writer(filename) as writer:
+                for log in self.interaction_logs:
+                    writer.write(log)
         print(f"Logs saved to {filename}")
     
     def print_summary(self) -> None:
@@ -256,6 +275,10 @@ def main():
     """
     Main function to run the NPC Chat System
     """
+    parser = argparse.ArgumentParser(description="Replay players.json through the v1 NPC chat system")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+    
     print("🤖 AI-Powered NPC Chat System")
     print("=" * 50)
     
@@ -266,7 +289,8 @@ def main():
     try:
         # Initialize the NPC chat system
         # Make sure to set your OPENAI_API_KEY environment variable
-      npc_system = NPCChatSystem('Enter Your API Key Here')
+        backend = backend_from_args(args)
+        npc_system = NPCChatSystem('Enter Your API Key Here', backend=backend)
         
         # Process all messages from the JSON file
         npc_system.process_messages_from_file('players.json')
@@ -276,6 +300,7 @@ def main():
         
         # Print summary
         npc_system.print_summary()
+        backend.close()
         
     except Exception as e:
         print(f"Error: {e}")
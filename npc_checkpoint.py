@@ -0,0 +1,201 @@
+import json
+import os
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+
+# -----------------------------
+# Durable file helpers
+# -----------------------------
+
+def _fsync_dir(path: str) -> None:
+    """Make a rename or a new file in this directory survive a crash"""
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:  # e.g. Windows, where directories can't be opened
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# -----------------------------
+# Checkpoint store
+# -----------------------------
+
+class CheckpointStore:
+    """Incremental checkpoints of a batch run: input cursor, log offset and per-player state.
+
+    Two files are kept next to each other:
+
+    - path: a snapshot, one JSON header line with the cursor followed by
+      one line per player. It is only ever replaced atomically (write to a
+      temp file, fsync, rename).
+    - path + ".journal": appended to by every save() with the players that
+      changed since the previous save, followed by a cursor line, then
+      fsynced. The cursor line is the commit marker; player lines after the
+      last cursor line belong to a save that never finished and are ignored.
+      Before the first save of a run, the journal is cut back to the end of
+      its last cursor line, so a torn tail left by a crash is never glued
+      to, or committed along with, the lines written after it.
+
+    Each save costs only the dirty players. Every compact_every saves the
+    journal is folded into a new snapshot and truncated.
+    """
+
+    def __init__(self, path: str, compact_every: int = 20):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._journal = None
+        self._journal_saves = 0
+
+        self.saves = 0
+        self.compactions = 0
+        self.players_written = 0
+        self.bytes_written = 0
+
+    def reset(self) -> None:
+        """Forget any earlier checkpoint, for a run that starts from the beginning"""
+        self.close()
+        for path in (self.path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._journal_saves = 0
+
+    # -- reading --
+
+    def _read_snapshot(self) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+        if not os.path.exists(self.path):
+            return None, {}
+        players = {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            for line in f:
+                entry = json.loads(line)
+                players[entry['player']] = entry['state']
+        return header, players
+
+    def _read_journal(self) -> Iterator[Dict[str, Any]]:
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    if not line.endswith("\n"):
+                        # Torn write from a crash mid-save, at the very end of the journal
+                        return
+                    # A damaged line inside the journal; later saves are still valid
+                    continue
+
+    def _committed_journal_bytes(self) -> int:
+        """Length of the journal up to and including its last cursor line"""
+        committed = offset = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                offset += len(line)
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'cursor' in entry:
+                    committed = offset
+        return committed
+
+    def _open_journal(self) -> None:
+        """Open the journal for appending, dropping whatever follows the last committed save"""
+        if os.path.exists(self.journal_path):
+            committed = self._committed_journal_bytes()
+            if committed < os.path.getsize(self.journal_path):
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(committed)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self._journal = open(self.journal_path, "ab")
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Latest committed checkpoint as {'cursor', 'log_offset', 'meta', 'players'}, or None"""
+        header, players = self._read_snapshot()
+        uncommitted: Dict[str, Any] = {}
+        for entry in self._read_journal():
+            if 'cursor' in entry:
+                players.update(uncommitted)
+                uncommitted = {}
+                header = entry
+            else:
+                uncommitted[entry['player']] = entry['state']
+        if header is None:
+            return None
+        return {
+            'cursor': header['cursor'],
+            'log_offset': header['log_offset'],
+            'meta': header.get('meta', {}),
+            # JSON object keys are strings; player ids are ints everywhere else
+            'players': {int(player_id): state for player_id, state in players.items()},
+        }
+
+    # -- writing --
+
+    def save(self, cursor: int, log_offset: int, players: Dict[int, Dict[str, Any]],
+             meta: Optional[Dict[str, Any]] = None) -> None:
+        """Durably record the players that changed and the position the run has reached"""
+        if self._journal is None:
+            self._open_journal()
+        lines = [json.dumps({'player': player_id, 'state': state}) for player_id, state in players.items()]
+        lines.append(json.dumps({'cursor': cursor, 'log_offset': log_offset, 'meta': meta or {}}))
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+        self.saves += 1
+        self.players_written += len(players)
+        self.bytes_written += len(data)
+        self._journal_saves += 1
+        if self._journal_saves >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """Fold the journal into a fresh snapshot and start an empty journal"""
+        checkpoint = self.load()
+        if checkpoint is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            header = {'cursor': checkpoint['cursor'], 'log_offset': checkpoint['log_offset'],
+                      'meta': checkpoint['meta']}
+            f.write(json.dumps(header) + "\n")
+            for player_id, state in checkpoint['players'].items():
+                f.write(json.dumps({'player': player_id, 'state': state}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_dir(os.path.dirname(self.path))
+
+        # Replaying the old journal on top of the new snapshot gives the same
+        # state, so a crash before this truncate is harmless
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path, "wb")
+        os.fsync(self._journal.fileno())
+        self._journal_saves = 0
+        self.compactions += 1
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'saves': self.saves,
+            'compactions': self.compactions,
+            'players_written': self.players_written,
+            'bytes_written': self.bytes_written,
+            'mean_players_per_save': round(self.players_written / self.saves, 1) if self.saves else 0.0,
+        }
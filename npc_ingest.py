@@ -0,0 +1,387 @@
+import codecs
+import heapq
+import itertools
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from operator import attrgetter
+from typing import Dict, Any, BinaryIO, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:  # sort_messages falls back to sorted()
+    np = None
+
+
+# -----------------------------
+# Message records
+# -----------------------------
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def timestamp_key(timestamp: str) -> int:
+    """ISO-8601 timestamp as integer microseconds since the epoch (naive times are taken as UTC)"""
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return (dt - _EPOCH) // _MICROSECOND
+
+def format_timestamp(ts_us: int) -> str:
+    return (_EPOCH + ts_us * _MICROSECOND).isoformat()
+
+
+class PlayerMessage:
+    """One player message with its timestamp parsed once into epoch microseconds.
+
+    Sorting and grouping compare the plain int ts_us; timestamp is the
+    input's own string, timezone offset and formatting included, and is
+    what results are logged with. Messages built without one get the naive
+    UTC ISO form of ts_us.
+    """
+    __slots__ = ("player_id", "text", "ts_us", "timestamp")
+
+    def __init__(self, player_id: int, text: str, ts_us: int, timestamp: Optional[str] = None):
+        self.player_id = player_id
+        self.text = text
+        self.ts_us = ts_us
+        self.timestamp = timestamp if timestamp is not None else format_timestamp(ts_us)
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'PlayerMessage':
+        timestamp = data['timestamp']
+        return cls(int(data['player_id']), data['text'], timestamp_key(timestamp), timestamp)
+
+    def as_datetime(self) -> datetime:
+        return _EPOCH + self.ts_us * _MICROSECOND
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'player_id': self.player_id, 'text': self.text, 'timestamp': self.timestamp}
+
+    def __eq__(self, other):
+        if not isinstance(other, PlayerMessage):
+            return NotImplemented
+        return (self.player_id, self.text, self.ts_us) == (other.player_id, other.text, other.ts_us)
+
+    def __repr__(self):
+        return f"PlayerMessage(player_id={self.player_id}, text={self.text!r}, timestamp={self.timestamp!r})"
+
+
+class IngestStats:
+    """Counts what a reader has produced and the time spent reading and parsing"""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes_read = 0
+        self.parse_seconds = 0.0
+
+    def messages_per_second(self) -> float:
+        return self.messages / self.parse_seconds if self.parse_seconds else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'messages': self.messages,
+            'bytes_read': self.bytes_read,
+            'parse_seconds': round(self.parse_seconds, 3),
+            'messages_per_second': round(self.messages_per_second(), 1),
+            'mb_per_second': round(self.bytes_read / self.parse_seconds / 1e6, 2) if self.parse_seconds else 0.0,
+        }
+
+
+def sort_messages(messages: Iterable[PlayerMessage]) -> List[PlayerMessage]:
+    """Timestamp-sort a finite feed; vectorized with NumPy when it is installed"""
+    if np is None:
+        return sorted(messages, key=attrgetter("ts_us"))
+    messages = messages if isinstance(messages, list) else list(messages)
+    ts_us = np.fromiter((message.ts_us for message in messages), dtype=np.int64, count=len(messages))
+    return [messages[i] for i in np.argsort(ts_us, kind='stable')]
+
+
+# -----------------------------
+# Streaming readers
+# -----------------------------
+
+def iter_messages(source: Union[str, BinaryIO], stats: Optional[IngestStats] = None,
+                  chunk_size: int = 1 << 16) -> Iterator[PlayerMessage]:
+    """Yield messages from a JSON array or ndjson feed without loading it whole.
+
+    source is a path, '-' for stdin, or a binary file object. The format is
+    picked from the first non-blank byte: '[' means a JSON array (like
+    players.json), anything else one JSON object per line. Memory stays
+    bounded by chunk_size plus one record. Time is only counted while the
+    generator is reading and parsing, not while the caller handles a record.
+    """
+    stats = stats if stats is not None else IngestStats()
+    if source == "-":
+        yield from _iter_file(sys.stdin.buffer, stats, chunk_size)
+    elif isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from _iter_file(f, stats, chunk_size)
+    else:
+        yield from _iter_file(source, stats, chunk_size)
+
+
+def _iter_file(f: BinaryIO, stats: IngestStats, chunk_size: int) -> Iterator[PlayerMessage]:
+    started = time.perf_counter()
+    head = b""
+    while True:
+        chunk = f.read(1) if not head.strip() else b""
+        if not chunk:
+            break
+        head += chunk
+    stats.bytes_read += len(head)
+    stats.parse_seconds += time.perf_counter() - started
+
+    if head.strip() == b"[":
+        records = _iter_json_array(f, stats, chunk_size)
+    else:
+        records = _iter_ndjson(f, head, stats)
+    yield from records
+
+
+def _iter_ndjson(f: BinaryIO, head: bytes, stats: IngestStats) -> Iterator[PlayerMessage]:
+    started = time.perf_counter()
+    lines = iter(f)
+    first_line = head + next(lines, b"")
+    for line in itertools.chain([first_line], lines):
+        stats.bytes_read += len(line) - (len(head) if line is first_line else 0)
+        if not line.strip():
+            continue
+        record = PlayerMessage.from_dict(json.loads(line))
+        stats.messages += 1
+        stats.parse_seconds += time.perf_counter() - started
+        yield record
+        started = time.perf_counter()
+    stats.parse_seconds += time.perf_counter() - started
+
+
+def _iter_json_array(f: BinaryIO, stats: IngestStats, chunk_size: int) -> Iterator[PlayerMessage]:
+    """Parse '[{...}, {...}]' one element at a time (the opening '[' is already consumed)"""
+    started = time.perf_counter()
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    while True:
+        # Skip separators between elements
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            break
+
+        data = end = None
+        if pos < len(buf):
+            try:
+                data, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Usually an element cut off at the end of the buffer
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Unterminated JSON array in message feed")
+
+        if end is None:
+            chunk = f.read(chunk_size)
+            stats.bytes_read += len(chunk)
+            eof = not chunk
+            # Drop what has been parsed so the buffer stays around chunk_size
+            buf = buf[pos:] + text_decoder.decode(chunk, final=eof)
+            pos = 0
+            continue
+
+        pos = end
+        record = PlayerMessage.from_dict(data)
+        stats.messages += 1
+        stats.parse_seconds += time.perf_counter() - started
+        yield record
+        started = time.perf_counter()
+
+    stats.parse_seconds += time.perf_counter() - started
+
+
+# -----------------------------
+# External merge sort
+# -----------------------------
+
+class SortStats:
+    def __init__(self):
+        self.records = 0
+        self.runs = 0
+        self.merge_passes = 0
+        self.spilled_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'records': self.records,
+            'runs': self.runs,
+            'merge_passes': self.merge_passes,
+            'spilled_bytes': self.spilled_bytes,
+        }
+
+
+def _spill_run(records: Iterable[PlayerMessage], tmp_dir: Optional[str], stats: SortStats) -> TextIO:
+    """Write records that are already in order to an anonymous temp file"""
+    run = tempfile.TemporaryFile("w+", encoding="utf-8", dir=tmp_dir)
+    for record in records:
+        line = json.dumps([record.ts_us, record.player_id, record.text, record.timestamp]) + "\n"
+        stats.spilled_bytes += len(line)
+        run.write(line)
+    run.seek(0)
+    stats.runs += 1
+    return run
+
+
+def _read_run(run: TextIO) -> Iterator[PlayerMessage]:
+    with run:
+        for line in run:
+            ts_us, player_id, text, timestamp = json.loads(line)
+            yield PlayerMessage(player_id, text, ts_us, timestamp)
+
+
+def external_sort(records: Iterable[PlayerMessage], run_size: int = 100000, tmp_dir: Optional[str] = None,
+                  max_open_runs: int = 128, stats: Optional[SortStats] = None) -> Iterator[PlayerMessage]:
+    """Sort records by timestamp using at most run_size records of memory.
+
+    Input is cut into runs of run_size records, each sorted in memory and
+    spilled to a temp file, then the runs are k-way merged with heapq.merge
+    and yielded as a generator. Timestamps were parsed once on ingest and
+    runs store the integer ts_us next to the original string, so nothing
+    is re-parsed. Records with equal
+    timestamps keep their input order, same as sorted(). Inputs that fit in
+    one run never touch the disk.
+    """
+    stats = stats if stats is not None else SortStats()
+    runs: List[TextIO] = []
+    buffer: List[PlayerMessage] = []
+    by_time = attrgetter("ts_us")
+
+    for record in records:
+        buffer.append(record)
+        stats.records += 1
+        if len(buffer) >= run_size:
+            buffer.sort(key=by_time)
+            runs.append(_spill_run(buffer, tmp_dir, stats))
+            buffer = []
+
+    buffer.sort(key=by_time)
+    if not runs:
+        yield from buffer
+        return
+
+    # Keep the number of open files bounded by merging the oldest runs first;
+    # merging consecutive runs keeps equal timestamps in input order
+    while len(runs) > max_open_runs:
+        merged = heapq.merge(*(_read_run(run) for run in runs[:max_open_runs]), key=by_time)
+        runs = [_spill_run(merged, tmp_dir, stats)] + runs[max_open_runs:]
+        stats.merge_passes += 1
+
+    stats.merge_passes += 1
+    sources = [_read_run(run) for run in runs] + [iter(buffer)]
+    yield from heapq.merge(*sources, key=by_time)
+
+
+# -----------------------------
+# Watermark reordering
+# -----------------------------
+
+class WatermarkReorderBuffer:
+    """Reorders a live, slightly out-of-order stream with bounded delay.
+
+    Messages wait in a min-heap keyed on timestamp. The watermark trails the
+    newest timestamp seen by allowed_lateness; everything at or below it is
+    released in timestamp order. A message that arrives below the watermark
+    is late: it is counted and, by default, released straight away (it can
+    no longer be put in order) or dropped with late_policy="drop".
+    max_buffer caps memory by force-releasing the oldest messages.
+    """
+
+    def __init__(self, allowed_lateness: float = 10.0, max_buffer: Optional[int] = None,
+                 late_policy: str = "emit"):
+        if late_policy not in ("emit", "drop"):
+            raise ValueError(f"Unknown late policy: {late_policy}")
+        self.lateness_us = int(allowed_lateness * 1_000_000)
+        self.max_buffer = max_buffer
+        self.late_policy = late_policy
+        self._heap: List[Tuple[int, int, PlayerMessage]] = []
+        self._seq = 0
+        self.max_seen: Optional[int] = None
+        self.watermark: Optional[int] = None
+
+        self.received = 0
+        self.released = 0
+        self.late = 0
+        self.dropped = 0
+        self.forced = 0
+        self.max_depth = 0
+        self.max_lateness_us = 0
+
+    def push(self, record: PlayerMessage) -> List[PlayerMessage]:
+        """Add a message and return whatever the watermark now releases, oldest first"""
+        key = record.ts_us
+        self.received += 1
+        if self.max_seen is not None and key < self.max_seen:
+            # How far behind the newest message this one arrived; size allowed_lateness from this
+            self.max_lateness_us = max(self.max_lateness_us, self.max_seen - key)
+
+        if self.watermark is not None and key < self.watermark:
+            self.late += 1
+            if self.late_policy == "drop":
+                self.dropped += 1
+                return []
+            self.released += 1
+            return [record]
+
+        heapq.heappush(self._heap, (key, self._seq, record))
+        self._seq += 1
+        self.max_depth = max(self.max_depth, len(self._heap))
+
+        if self.max_seen is None or key > self.max_seen:
+            self.max_seen = key
+            self.watermark = max(self.watermark or key - self.lateness_us, key - self.lateness_us)
+
+        released = []
+        while self._heap and self._heap[0][0] <= self.watermark:
+            released.append(heapq.heappop(self._heap)[2])
+        while self.max_buffer is not None and len(self._heap) > self.max_buffer:
+            key, _, oldest = heapq.heappop(self._heap)
+            # Releasing early means anything older arriving later is late
+            self.watermark = max(self.watermark, key)
+            self.forced += 1
+            released.append(oldest)
+        self.released += len(released)
+        return released
+
+    def flush(self) -> List[PlayerMessage]:
+        """Release everything still buffered (end of stream)"""
+        released = [heapq.heappop(self._heap)[2] for _ in range(len(self._heap))]
+        if self.max_seen is not None:
+            self.watermark = self.max_seen
+        self.released += len(released)
+        return released
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'received': self.received,
+            'released': self.released,
+            'buffer_depth': len(self._heap),
+            'max_buffer_depth': self.max_depth,
+            'late': self.late,
+            'dropped': self.dropped,
+            'forced_releases': self.forced,
+            'max_observed_lateness_seconds': self.max_lateness_us / 1_000_000,
+            'watermark': format_timestamp(self.watermark) if self.watermark is not None else None,
+        }
+
+
+def reorder_stream(records: Iterable[PlayerMessage], buffer: WatermarkReorderBuffer) -> Iterator[PlayerMessage]:
+    """Yield an unbounded stream in timestamp order as the buffer's watermark advances"""
+    for record in records:
+        yield from buffer.push(record)
+    yield from buffer.flush()
@@ -0,0 +1,739 @@
+"""Writing and post-processing of the interaction logs of npc_chat.py.
+
+BufferedJSONLWriter is the runner's log sink: records are serialized on the
+calling thread and written out in batches by a background thread, as plain,
+gzip or zstd JSONL. NpzLogWriter and ParquetLogWriter store the same records
+column by column for analytics; create_log_writer picks one by file name.
+
+With --history delta every log line holds only its own turn (player_message
+and npc_response) plus a (conversation_id, turn_index) reference, so log
+size grows linearly with the number of messages. This module rebuilds full
+histories from such logs when they are needed:
+
+    python npc_logs.py expand logs/run.jsonl -o logs/run.full.jsonl
+    python npc_logs.py history logs/run.jsonl 3:merchant
+    python npc_logs.py convert chat_history.json -o logs/chat_history.npz
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from npc_ingest import format_timestamp, timestamp_key
+
+try:
+    import orjson
+except ImportError:  # the standard json module is used instead
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst logs
+    zstandard = None
+
+try:
+    import numpy as np
+except ImportError:  # only needed for .npz logs
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for .parquet logs
+    pa = None
+    pq = None
+
+
+def conversation_id(player_id: int, npc_key: str) -> str:
+    """Stable id for the conversation between one player and one NPC"""
+    return f"{player_id}:{npc_key}"
+
+
+# -----------------------------
+# Writing
+# -----------------------------
+
+def json_line_encoder(fast: bool = True) -> Callable[[Dict[str, Any]], bytes]:
+    """Encoder from a record to one JSONL line; uses orjson when fast and installed"""
+    if fast and orjson is not None:
+        return lambda record: orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return lambda record: (json.dumps(record) + "\n").encode("utf-8")
+
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+
+def _compressed_writer(raw, compression: str, level: Optional[int] = None):
+    """Wrap a binary file in a compressing stream; closing the stream leaves raw open"""
+    if compression == "none":
+        return raw
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6 if level is None else level)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd logs require zstandard (pip install zstandard)")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(raw, closefd=False)
+    raise ValueError(f"Unknown log compression: {compression}")
+
+
+class BufferedJSONLWriter:
+    """JSONL log sink that keeps file I/O off the request path.
+
+    write() only serializes the record and appends it to an in-memory batch.
+    A background thread writes the batch out once it reaches flush_bytes or
+    every flush_interval seconds, whichever comes first. Writers block when
+    max_buffer_bytes are waiting, so a slow disk can't grow the buffer
+    without bound. close() writes everything left and fsyncs the file, so a
+    clean shutdown never loses records.
+
+    With compression every flush ends a compressed block, so a crashed run
+    still leaves a readable prefix of the log.
+
+    truncate_to reopens an existing uncompressed log and cuts it back to
+    that byte offset before appending, which is how a resumed run drops
+    records written after its last checkpoint.
+    """
+
+    def __init__(self, path: str, flush_bytes: int = 1 << 20, flush_interval: float = 1.0,
+                 max_buffer_bytes: Optional[int] = None, fast_json: bool = True, fsync: bool = True,
+                 compression: str = "none", level: Optional[int] = None, truncate_to: Optional[int] = None):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_buffer_bytes = max_buffer_bytes or 8 * flush_bytes
+        self.fsync = fsync
+        self.encode = json_line_encoder(fast_json)
+        self.encoder_name = "orjson" if fast_json and orjson is not None else "json"
+        self.compression = compression
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if truncate_to is not None:
+            if compression != "none":
+                raise ValueError("Only uncompressed logs can be truncated and appended to")
+            self._raw = open(path, "r+b")
+            self._raw.truncate(truncate_to)
+            self._raw.seek(truncate_to)
+        else:
+            self._raw = open(path, "wb")
+        self._file = _compressed_writer(self._raw, compression, level)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._batch: List[bytes] = []
+        self._batch_bytes = 0
+        self._writing = False
+        self._flush_requested = False
+        self._closed = False
+        self._error: Optional[BaseException] = None
+
+        self.records = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.file_bytes = 0
+        self._opened_at = time.perf_counter()
+        self._closed_at: Optional[float] = None
+
+        self._thread = threading.Thread(target=self._run, name="jsonl-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = self.encode(record)
+        with self._lock:
+            if self._error is not None:
+                raise IOError(f"Log writer for {self.path} failed") from self._error
+            if self._closed:
+                raise ValueError("write to closed BufferedJSONLWriter")
+            if self._batch_bytes >= self.max_buffer_bytes:
+                started = time.perf_counter()
+                self._wake.notify()
+                self._drained.wait_for(lambda: self._batch_bytes < self.max_buffer_bytes or self._error is not None)
+                self.blocked_seconds += time.perf_counter() - started
+                if self._error is not None:
+                    raise IOError(f"Log writer for {self.path} failed") from self._error
+            self._batch.append(line)
+            self._batch_bytes += len(line)
+            self.records += 1
+            if self._batch_bytes >= self.flush_bytes:
+                self._wake.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                self._wake.wait_for(
+                    lambda: self._closed or self._flush_requested or self._batch_bytes >= self.flush_bytes,
+                    timeout=self.flush_interval)
+                batch, size = self._batch, self._batch_bytes
+                self._batch, self._batch_bytes = [], 0
+                self._flush_requested = False
+                self._writing = bool(batch)
+                closing = self._closed
+                self._drained.notify_all()
+
+            if batch:
+                started = time.perf_counter()
+                try:
+                    self._file.write(b"".join(batch))
+                    self._file.flush()
+                except BaseException as e:
+                    with self._lock:
+                        self._error = e
+                        self._drained.notify_all()
+                    return
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self._writing = False
+                    self._drained.notify_all()
+                    self.flushes += 1
+                    self.bytes_written += size
+                    self.flush_seconds += elapsed
+                    self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+
+            if closing:
+                return
+
+    def sync(self) -> int:
+        """Write out and fsync everything written so far; returns the file offset it ends at.
+
+        Blocks the caller, so it is meant for checkpoints, not every record.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("sync on closed BufferedJSONLWriter")
+            self._flush_requested = True
+            self._wake.notify()
+            self._drained.wait_for(lambda: (not self._batch and not self._writing) or self._error is not None)
+            if self._error is not None:
+                raise IOError(f"Log writer for {self.path} failed") from self._error
+            # The writer thread is idle until the lock is released
+            if self._file is not self._raw:
+                self._file.flush()
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+            return self._raw.tell()
+
+    def close(self) -> None:
+        """Write out every buffered record and (optionally) fsync the file"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+        try:
+            if self._file is not self._raw:
+                self._file.close()
+            self._raw.flush()
+            if self.fsync and self._error is None:
+                os.fsync(self._raw.fileno())
+            self.file_bytes = self._raw.tell()
+        finally:
+            self._raw.close()
+            self._closed_at = time.perf_counter()
+        if self._error is not None:
+            raise IOError(f"Log writer for {self.path} failed") from self._error
+
+    def __enter__(self) -> "BufferedJSONLWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = (self._closed_at or time.perf_counter()) - self._opened_at
+            return {
+                'encoder': self.encoder_name,
+                'format': "jsonl" if self.compression == "none" else f"jsonl+{self.compression}",
+                'records': self.records,
+                'bytes_written': self.bytes_written,
+                # Size on disk, known after close(); differs from bytes_written when compressed
+                'file_bytes': self.file_bytes,
+                'flushes': self.flushes,
+                'bytes_per_second': round(self.bytes_written / elapsed) if elapsed else 0,
+                # Throughput of the flushes themselves, i.e. what the disk sustains
+                'write_bytes_per_second': round(self.bytes_written / self.flush_seconds) if self.flush_seconds else 0,
+                'mean_flush_ms': round(self.flush_seconds / self.flushes * 1000, 3) if self.flushes else 0.0,
+                'max_flush_ms': round(self.max_flush_seconds * 1000, 3),
+                'blocked_seconds': round(self.blocked_seconds, 3),
+            }
+
+
+# -----------------------------
+# Columnar formats
+# -----------------------------
+
+# Columns of npz and parquet logs. NPC name, role, mood and conversation id
+# repeat on almost every row, so they are dictionary-encoded; the
+# timestamp is stored as epoch microseconds and the history as JSON text.
+CATEGORY_COLUMNS = ("npc_name", "npc_role", "npc_mood", "conversation_id")
+INTEGER_COLUMNS = ("ts_us", "player_id", "turn_index")
+TEXT_COLUMNS = ("player_message", "npc_response", "history")
+
+# Field names of npc_chat_v1 interaction logs
+_V1_FIELDS = {'message_text': 'player_message', 'npc_reply': 'npc_response', 'conversation_state': 'history'}
+
+
+def _column_values(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten one log record (either runner's schema) into column values"""
+    row = {_V1_FIELDS.get(key, key): value for key, value in record.items()}
+    history = row.get('history', row.get('conversation_history'))
+    turn_index = row.get('turn_index')
+    return {
+        'ts_us': timestamp_key(row['timestamp']),
+        'player_id': int(row['player_id']),
+        'turn_index': -1 if turn_index is None else int(turn_index),
+        'npc_name': row.get('npc_name', ""),
+        'npc_role': row.get('npc_role', ""),
+        'npc_mood': row.get('npc_mood', ""),
+        'conversation_id': row.get('conversation_id', ""),
+        'player_message': row.get('player_message', ""),
+        'npc_response': row.get('npc_response', ""),
+        'history': "" if history is None else json.dumps(history, ensure_ascii=False),
+    }
+
+
+def _record_from_columns(values: Dict[str, Any]) -> Dict[str, Any]:
+    """Inverse of _column_values, in the main runner's record layout"""
+    record = {
+        'timestamp': format_timestamp(values['ts_us']),
+        'player_id': values['player_id'],
+        'player_message': values['player_message'],
+        'npc_name': values['npc_name'],
+        'npc_role': values['npc_role'],
+        'npc_mood': values['npc_mood'],
+        'npc_response': values['npc_response'],
+    }
+    if values['conversation_id']:
+        record['conversation_id'] = values['conversation_id']
+        record['turn_index'] = None if values['turn_index'] < 0 else values['turn_index']
+    if values['history']:
+        record['conversation_history'] = json.loads(values['history'])
+    return record
+
+
+class _ColumnarLogWriter:
+    """Shared part of the columnar writers: rows are collected per column under a lock"""
+
+    format_name = ""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._columns: Dict[str, List[Any]] = {name: [] for name in INTEGER_COLUMNS + CATEGORY_COLUMNS + TEXT_COLUMNS}
+        self._closed = False
+        self.records = 0
+        self.file_bytes = 0
+        self.encode_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def write(self, record: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        values = _column_values(record)
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"write to closed {type(self).__name__}")
+            for name, value in values.items():
+                self._columns[name].append(value)
+            self.records += 1
+            self.encode_seconds += time.perf_counter() - started
+            self._after_write()
+
+    def _after_write(self) -> None:
+        pass
+
+    def _take_columns(self) -> Dict[str, List[Any]]:
+        columns = self._columns
+        self._columns = {name: [] for name in columns}
+        return columns
+
+    def _finish(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            started = time.perf_counter()
+            self._finish()
+            self.write_seconds += time.perf_counter() - started
+            self.file_bytes = os.path.getsize(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = self.encode_seconds + self.write_seconds
+        return {
+            'format': self.format_name,
+            'records': self.records,
+            'file_bytes': self.file_bytes,
+            'encode_seconds': round(self.encode_seconds, 3),
+            'write_seconds': round(self.write_seconds, 3),
+            'records_per_second': round(self.records / elapsed) if elapsed else 0,
+        }
+
+
+def _encode_text(values: List[str]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Strings as one UTF-8 byte array plus int64 offsets, so the file needs no pickling"""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _decode_text(data: "np.ndarray", offsets: "np.ndarray") -> List[str]:
+    blob = data.tobytes()
+    return [blob[start:end].decode("utf-8") for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def _encode_categories(values: List[str]) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Dictionary encoding: int32 codes into a sorted array of distinct values"""
+    categories, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return codes.astype(np.int32), categories
+
+
+class NpzLogWriter(_ColumnarLogWriter):
+    """Interaction log as a compressed NumPy .npz of column arrays.
+
+    Rows are kept in memory until close(), so this suits per-run and
+    per-day files; use parquet for very large single files.
+    """
+
+    format_name = "npz"
+
+    def __init__(self, path: str, compress: bool = True):
+        if np is None:
+            raise ImportError("npz logs require numpy (pip install numpy)")
+        super().__init__(path)
+        self.compress = compress
+
+    def _finish(self) -> None:
+        columns = self._take_columns()
+        arrays = {name: np.array(columns[name], dtype=np.int64) for name in INTEGER_COLUMNS}
+        for name in CATEGORY_COLUMNS:
+            arrays[f"{name}.codes"], arrays[f"{name}.categories"] = _encode_categories(columns[name])
+        for name in TEXT_COLUMNS:
+            arrays[f"{name}.data"], arrays[f"{name}.offsets"] = _encode_text(columns[name])
+        save = np.savez_compressed if self.compress else np.savez
+        # A file object keeps numpy from appending .npz to the name
+        with open(self.path, "wb") as f:
+            save(f, **arrays)
+
+
+class ParquetLogWriter(_ColumnarLogWriter):
+    """Interaction log as Parquet with dictionary-encoded category columns.
+
+    Rows are written out every row_group_size records, so memory stays
+    bounded no matter how long the run is.
+    """
+
+    format_name = "parquet"
+
+    def __init__(self, path: str, row_group_size: int = 65536, compression: str = "zstd"):
+        if pa is None:
+            raise ImportError("parquet logs require pyarrow (pip install pyarrow)")
+        super().__init__(path)
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self._writer = None
+
+    def _flush_row_group(self) -> None:
+        columns = self._take_columns()
+        arrays = {name: pa.array(columns[name], type=pa.int64()) for name in INTEGER_COLUMNS}
+        for name in CATEGORY_COLUMNS:
+            arrays[name] = pa.array(columns[name], type=pa.string()).dictionary_encode()
+        for name in TEXT_COLUMNS:
+            arrays[name] = pa.array(columns[name], type=pa.string())
+        table = pa.table(arrays)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema, compression=self.compression)
+        self._writer.write_table(table)
+
+    def _after_write(self) -> None:
+        if len(self._columns['ts_us']) >= self.row_group_size:
+            started = time.perf_counter()
+            self._flush_row_group()
+            self.write_seconds += time.perf_counter() - started
+
+    def _finish(self) -> None:
+        if self._columns['ts_us'] or self._writer is None:
+            self._flush_row_group()
+        self._writer.close()
+
+
+LOG_FORMATS = ("jsonl", "gzip", "zstd", "npz", "parquet")
+
+def log_format_for_path(path: str) -> str:
+    """Log format implied by a file name (.jsonl, .gz, .zst, .npz, .parquet)"""
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    if path.endswith(".npz"):
+        return "npz"
+    if path.endswith(".parquet"):
+        return "parquet"
+    return "jsonl"
+
+
+def create_log_writer(path: str, fmt: Optional[str] = None, **options):
+    """Log sink for a path; fmt defaults to the format implied by the file name.
+
+    Every writer has write(record), close() and stats(); options go to the
+    JSONL writer (flush_bytes, flush_interval, ...) and are ignored by the
+    columnar ones.
+    """
+    fmt = fmt or log_format_for_path(path)
+    if fmt == "npz":
+        return NpzLogWriter(path)
+    if fmt == "parquet":
+        return ParquetLogWriter(path)
+    if fmt == "jsonl":
+        return BufferedJSONLWriter(path, **options)
+    if fmt in ("gzip", "zstd"):
+        return BufferedJSONLWriter(path, compression=fmt, **options)
+    raise ValueError(f"Unknown log format: {fmt}")
+
+
+# -----------------------------
+# Reading
+# -----------------------------
+
+def load_columns(path: str, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """Columns of an npz or parquet log for analytics (all of them, or only names).
+
+    Category columns come back as (codes, categories) pairs so they can be
+    counted or filtered without decoding every row, e.g.
+    np.bincount(codes) for a mood distribution. Only the requested columns
+    are read from disk.
+    """
+    names = list(names) if names is not None else list(INTEGER_COLUMNS + CATEGORY_COLUMNS + TEXT_COLUMNS)
+    fmt = log_format_for_path(path)
+    if fmt == "npz":
+        if np is None:
+            raise ImportError("npz logs require numpy (pip install numpy)")
+        columns = {}
+        with np.load(path) as data:
+            for name in names:
+                if name in CATEGORY_COLUMNS:
+                    columns[name] = (data[f"{name}.codes"], data[f"{name}.categories"])
+                elif name in TEXT_COLUMNS:
+                    columns[name] = _decode_text(data[f"{name}.data"], data[f"{name}.offsets"])
+                else:
+                    columns[name] = data[name]
+        return columns
+    if fmt == "parquet":
+        if pa is None:
+            raise ImportError("parquet logs require pyarrow (pip install pyarrow)")
+        table = pq.read_table(path, columns=names)
+        columns = {}
+        for name in names:
+            if name in CATEGORY_COLUMNS:
+                # Row groups carry their own dictionaries; re-encode once over the whole column
+                encoded = table.column(name).cast(pa.string()).combine_chunks().dictionary_encode()
+                columns[name] = (encoded.indices.to_numpy(), encoded.dictionary.to_numpy(zero_copy_only=False))
+            elif name in TEXT_COLUMNS:
+                columns[name] = table.column(name).to_pylist()
+            else:
+                columns[name] = table.column(name).to_numpy()
+        return columns
+    raise ValueError(f"{path} is not a columnar log")
+
+
+def _iter_columnar(path: str) -> Iterator[Dict[str, Any]]:
+    columns = load_columns(path)
+    plain = {name: columns[name].tolist() for name in INTEGER_COLUMNS}
+    plain.update((name, columns[name]) for name in TEXT_COLUMNS)
+    categories = {}
+    for name in CATEGORY_COLUMNS:
+        codes, values = columns[name]
+        categories[name] = (codes.tolist(), values.tolist())
+    for i in range(len(plain['ts_us'])):
+        values = {name: column[i] for name, column in plain.items()}
+        for name, (codes, names) in categories.items():
+            values[name] = names[codes[i]]
+        yield _record_from_columns(values)
+
+
+def _open_text(path: str):
+    fmt = log_format_for_path(path)
+    if fmt == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if fmt == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd logs require zstandard (pip install zstandard)")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def read_log(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of an interaction log in any supported format ('-' reads JSONL from stdin)"""
+    if path != "-" and log_format_for_path(path) in ("npz", "parquet"):
+        yield from _iter_columnar(path)
+        return
+    handle = sys.stdin if path == "-" else _open_text(path)
+    try:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def load_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a log, or of a saved JSON document (chat_history.json or an npc_chat_v1 log file)"""
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            document = json.load(f)
+        yield from document['interactions'] if isinstance(document, dict) else document
+        return
+    yield from read_log(path)
+
+
+def convert_log(src: str, dst: str, fmt: Optional[str] = None) -> Dict[str, Any]:
+    """Copy every record of src into dst in another format; returns the writer's stats"""
+    writer = create_log_writer(dst, fmt)
+    with writer:
+        for record in load_records(src):
+            writer.write(record)
+    return writer.stats()
+
+
+Turn = Tuple[str, str]
+
+def _place_turn(turns: List[Optional[Turn]], record: Dict[str, Any]) -> None:
+    """Store (player_message, npc_response) at the record's turn_index"""
+    index = record['turn_index']
+    if index >= len(turns):
+        turns.extend([None] * (index + 1 - len(turns)))
+    turns[index] = (record['player_message'], record['npc_response'])
+
+
+def _history_entries(turns: List[Optional[Turn]], upto: int,
+                     window: Optional[int]) -> List[Dict[str, str]]:
+    """conversation_history entries in the same shape --history full writes"""
+    recorded = [turn for turn in turns[:upto] if turn is not None]
+    if window:
+        recorded = recorded[-window:]
+    history = []
+    for player_message, npc_response in recorded:
+        history.append({"player": player_message})
+        history.append({"npc": npc_response})
+    return history
+
+
+# -----------------------------
+# Reconstruction
+# -----------------------------
+
+def expand_records(records: Iterable[Dict[str, Any]], window: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Turn delta records back into records with a conversation_history.
+
+    The history of a record holds every recorded turn of its conversation up
+    to and including its own (the last window turns when window is given).
+    Records without a conversation_id (full-history logs) pass through as-is.
+    Turns are placed by turn_index, so lines from concurrent runs may be
+    interleaved across players.
+    """
+    turns: Dict[str, List[Optional[Turn]]] = {}
+    for record in records:
+        if 'conversation_id' not in record:
+            yield record
+            continue
+
+        history = turns.setdefault(record['conversation_id'], [])
+        if record['turn_index'] is not None:
+            _place_turn(history, record)
+            upto = record['turn_index'] + 1
+        else:
+            # A failed turn sees the history as it was when it ran
+            upto = len(history)
+
+        expanded = {key: value for key, value in record.items() if key not in ('conversation_id', 'turn_index')}
+        expanded['conversation_history'] = _history_entries(history, upto, window)
+        yield expanded
+
+
+def conversation_history(records: Iterable[Dict[str, Any]], conversation: str,
+                         upto_turn: Optional[int] = None) -> List[Dict[str, str]]:
+    """Full history of one conversation, optionally only up to turn upto_turn (inclusive)"""
+    turns: List[Optional[Turn]] = []
+    for record in records:
+        if record.get('conversation_id') != conversation or record.get('turn_index') is None:
+            continue
+        if upto_turn is not None and record['turn_index'] > upto_turn:
+            continue
+        _place_turn(turns, record)
+    return _history_entries(turns, len(turns), None)
+
+
+def expand_log(src: str, dst: str, window: Optional[int] = None) -> int:
+    """Write an expanded copy of a delta log; returns the number of records"""
+    count = 0
+    out = sys.stdout if dst == "-" else open(dst, "w", encoding="utf-8")
+    try:
+        for record in expand_records(read_log(src), window=window):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return count
+
+
+# -----------------------------
+# Command line
+# -----------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild, inspect and convert NPC interaction logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    expand = commands.add_parser("expand", help="Add a conversation_history to every record of a delta log")
+    expand.add_argument("log", help="Delta JSONL log ('-' reads stdin)")
+    expand.add_argument("-o", "--output", default="-", help="Output JSONL file (default: stdout)")
+    expand.add_argument("--window", type=int, default=None,
+                        help="Keep only the last N turns in each history (default: all)")
+
+    history = commands.add_parser("history", help="Print the history of one conversation")
+    history.add_argument("log", help="Delta JSONL log ('-' reads stdin)")
+    history.add_argument("conversation_id", help="Conversation id, e.g. 3:merchant")
+    history.add_argument("--upto", type=int, default=None, help="Last turn index to include")
+
+    convert = commands.add_parser("convert", help="Rewrite a log or chat_history.json in another format")
+    convert.add_argument("log", help="Source log (.jsonl, .gz, .zst, .npz, .parquet or a saved .json)")
+    convert.add_argument("-o", "--output", required=True, help="Destination; the format follows the extension")
+    convert.add_argument("--format", choices=LOG_FORMATS, default=None, help="Override the output format")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "expand":
+        count = expand_log(args.log, args.output, window=args.window)
+        print(f"Expanded {count} records", file=sys.stderr)
+    elif args.command == "convert":
+        stats = convert_log(args.log, args.output, args.format)
+        print(f"Wrote {stats['records']} records to {args.output} ({stats['file_bytes']} bytes)", file=sys.stderr)
+    else:
+        history = conversation_history(read_log(args.log), args.conversation_id, upto_turn=args.upto)
+        print(json.dumps(history, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from pydantic import PrivateAttr
+
+from npc_metrics import NULL_METRICS
+
+
+# -----------------------------
+# Background summarization
+# -----------------------------
+
+class BackgroundSummarizer:
+    """Shared worker pool that runs conversation summarization off the request path"""
+
+    def __init__(self, max_workers: int = 2, metrics=None):
+        self.metrics = metrics or NULL_METRICS
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="npc-summarizer")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._idle = threading.Condition(self._lock)
+
+        self.deferred = 0       # prunes handed to the pool instead of blocking the request
+        self.coalesced = 0      # prunes folded into a summarization already queued for that player
+        self.completed = 0
+        self.failed = 0
+        self.dropped_messages = 0
+        self.summary_seconds = 0.0
+
+    def submit(self, fn) -> None:
+        with self._lock:
+            self._in_flight += 1
+            self.deferred += 1
+        self.executor.submit(self._run, fn)
+
+    def _run(self, fn) -> None:
+        started = time.perf_counter()
+        try:
+            fn()
+            ok = True
+        except Exception as e:
+            print(f"Error summarizing conversation: {e}")
+            ok = False
+        elapsed = time.perf_counter() - started
+        self.metrics.observe("summarize_seconds", elapsed)
+        with self._lock:
+            self.summary_seconds += elapsed
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def record(self, coalesced: int = 0, dropped_messages: int = 0) -> None:
+        with self._lock:
+            self.coalesced += coalesced
+            self.dropped_messages += dropped_messages
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Block until every queued summarization has finished"""
+        with self._lock:
+            return self._idle.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'deferred': self.deferred,
+                'coalesced': self.coalesced,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': self._in_flight,
+                'dropped_messages': self.dropped_messages,
+                'summary_seconds': round(self.summary_seconds, 3),
+            }
+
+
+class BackgroundSummaryBufferMemory(ConversationSummaryBufferMemory):
+    """ConversationSummaryBufferMemory that never summarizes on the request path.
+
+    When the raw window exceeds max_token_limit the oldest messages move to a
+    pending list and a summarization job is queued on the shared
+    BackgroundSummarizer. Until the job finishes the pending messages are
+    still shown verbatim, so no context is lost while waiting. Prunes that
+    happen while a job is queued or running are folded into a single
+    follow-up job instead of queuing one LLM call each.
+
+    With a token_counter (npc_tokens.TokenCounter) messages are counted
+    with its cached tokenizer instead of the LLM's, and each message only
+    once per prune.
+    """
+
+    summarizer: BackgroundSummarizer
+    max_pending_messages: int = 40
+    token_counter: Optional[Any] = None
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _pending: List[BaseMessage] = PrivateAttr(default_factory=list)
+    _scheduled: bool = PrivateAttr(default=False)
+
+    def _history_buffer(self) -> List[BaseMessage]:
+        with self._lock:
+            buffer = list(self._pending) + list(self.chat_memory.messages)
+            summary = self.moving_summary_buffer
+        if summary:
+            buffer = [self.summary_message_cls(content=summary)] + buffer
+        return buffer
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        buffer = self._history_buffer()
+        if self.return_messages:
+            return {self.memory_key: buffer}
+        return {self.memory_key: get_buffer_string(buffer, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)}
+
+    async def aload_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        return self.load_memory_variables(inputs)
+
+    def prune(self) -> None:
+        buffer = self.chat_memory.messages
+        pruned = []
+        if self.token_counter is not None:
+            costs = [self.token_counter.count_message(str(msg.content)) for msg in buffer]
+            curr_buffer_length = sum(costs)
+            while buffer and curr_buffer_length > self.max_token_limit:
+                pruned.append(buffer.pop(0))
+                curr_buffer_length -= costs.pop(0)
+        else:
+            curr_buffer_length = self.llm.get_num_tokens_from_messages(buffer)
+            while buffer and curr_buffer_length > self.max_token_limit:
+                pruned.append(buffer.pop(0))
+                curr_buffer_length = self.llm.get_num_tokens_from_messages(buffer)
+        if not pruned:
+            return
+
+        with self._lock:
+            self._pending.extend(pruned)
+            overflow = len(self._pending) - self.max_pending_messages
+            if overflow > 0:
+                # The summarizer is falling behind (e.g. the API is down); keep the newest
+                del self._pending[:overflow]
+                self.summarizer.record(dropped_messages=overflow)
+            if self._scheduled:
+                self.summarizer.record(coalesced=1)
+                return
+            self._scheduled = True
+        self.summarizer.submit(self._summarize_pending)
+
+    async def aprune(self) -> None:
+        # Scheduling is non-blocking, so the sync version is fine on the event loop
+        self.prune()
+
+    def _summarize_pending(self) -> None:
+        with self._lock:
+            batch = self._pending[:]
+            summary = self.moving_summary_buffer
+        try:
+            new_summary = self.predict_new_summary(batch, summary) if batch else summary
+        except Exception:
+            with self._lock:
+                self._scheduled = False
+            raise
+
+        with self._lock:
+            self.moving_summary_buffer = new_summary
+            # Messages pruned while the LLM call ran stay pending for the next job
+            summarized = {id(msg) for msg in batch}
+            self._pending = [msg for msg in self._pending if id(msg) not in summarized]
+            reschedule = bool(self._pending)
+            self._scheduled = reschedule
+        if reschedule:
+            self.summarizer.submit(self._summarize_pending)
+
+    def pending_messages(self) -> List[BaseMessage]:
+        with self._lock:
+            return list(self._pending)
+
+    def clear(self) -> None:
+        super().clear()
+        with self._lock:
+            self._pending.clear()
+
+
+# -----------------------------
+# Native memory
+# -----------------------------
+
+class StringPool:
+    """Shared, reference-counted store of message texts.
+
+    Conversations hold integer ids instead of strings, so a text repeated
+    across players (greetings, cached replies) is stored once. Slots of
+    texts nobody references any more are reused.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+        self._texts: List[Optional[str]] = []
+        self._refs: List[int] = []
+        self._free: List[int] = []
+        self.interned = 0   # intern() calls that found the text already pooled
+
+    def intern(self, text: str) -> int:
+        with self._lock:
+            text_id = self._ids.get(text)
+            if text_id is not None:
+                self._refs[text_id] += 1
+                self.interned += 1
+                return text_id
+            if self._free:
+                text_id = self._free.pop()
+                self._texts[text_id] = text
+                self._refs[text_id] = 1
+            else:
+                text_id = len(self._texts)
+                self._texts.append(text)
+                self._refs.append(1)
+            self._ids[text] = text_id
+            return text_id
+
+    def get(self, text_id: int) -> str:
+        return self._texts[text_id]
+
+    def release(self, text_id: int) -> None:
+        with self._lock:
+            self._refs[text_id] -= 1
+            if self._refs[text_id] == 0:
+                del self._ids[self._texts[text_id]]
+                self._texts[text_id] = None
+                self._free.append(text_id)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'texts': len(self._ids),
+                'text_bytes': sum(len(text) for text in self._ids),
+                'references': sum(self._refs),
+                'interned': self.interned,
+            }
+
+
+class NativeConversationMemory:
+    """Last max_turns turns of one conversation as a ring buffer of StringPool ids.
+
+    A drop-in for the per-player ConversationSummaryBufferMemory when many
+    players are live at once: one small object and one array per player,
+    no LLM reference and no summarization. Older turns simply fall out of
+    the window.
+    """
+    __slots__ = ("pool", "max_turns", "summary", "_ids", "_start", "_count")
+
+    def __init__(self, pool: StringPool, max_turns: int = 6):
+        if max_turns < 1:
+            raise ValueError(f"NativeConversationMemory needs at least one turn, got {max_turns}")
+        self.pool = pool
+        self.max_turns = max_turns
+        self.summary = ""
+        # Two slots per turn: player text id, NPC text id
+        self._ids = array("q", [-1]) * (2 * max_turns)
+        self._start = 0
+        self._count = 0
+
+    def add_turn(self, player_text: str, npc_text: str) -> None:
+        if self._count == self.max_turns:
+            slot = self._start
+            self.pool.release(self._ids[2 * slot])
+            self.pool.release(self._ids[2 * slot + 1])
+            self._start = (self._start + 1) % self.max_turns
+        else:
+            slot = (self._start + self._count) % self.max_turns
+            self._count += 1
+        self._ids[2 * slot] = self.pool.intern(player_text)
+        self._ids[2 * slot + 1] = self.pool.intern(npc_text)
+
+    def turns(self) -> List[Tuple[str, str]]:
+        """(player text, NPC text) pairs, oldest first"""
+        pool, ids = self.pool, self._ids
+        pairs = []
+        for i in range(self._count):
+            slot = (self._start + i) % self.max_turns
+            pairs.append((pool.get(ids[2 * slot]), pool.get(ids[2 * slot + 1])))
+        return pairs
+
+    def history_messages(self, turns: Optional[List[Tuple[str, str]]] = None) -> List[BaseMessage]:
+        """The history part of the NPC prompt, from all turns or the given subset"""
+        messages: List[BaseMessage] = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"Summary of earlier conversation: {self.summary}"))
+        for player_text, npc_text in self.turns() if turns is None else turns:
+            messages.append(HumanMessage(content=player_text))
+            messages.append(AIMessage(content=npc_text))
+        return messages
+
+    def clear(self) -> None:
+        for i in range(self._count):
+            slot = (self._start + i) % self.max_turns
+            self.pool.release(self._ids[2 * slot])
+            self.pool.release(self._ids[2 * slot + 1])
+        self._start = 0
+        self._count = 0
+        self.summary = ""
+
+    def __len__(self) -> int:
+        return self._count
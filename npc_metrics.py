@@ -0,0 +1,315 @@
+import math
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Callable, List, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# -----------------------------
+# Histograms and counters
+# -----------------------------
+
+class LatencyHistogram:
+    """HDR-style histogram of durations.
+
+    Values are kept in microseconds: exact below 64us, then 32 buckets per
+    power of two, so any percentile is within ~3% of the true value from
+    microseconds up to ~19 hours. record() is O(1) on a fixed 1024-slot
+    array; nothing is allocated per value.
+    """
+
+    SLOTS = 1024
+
+    def __init__(self):
+        self._counts = [0] * self.SLOTS
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(us: int) -> int:
+        if us < 64:
+            return us
+        shift = us.bit_length() - 6
+        return 64 + (shift - 1) * 32 + (us >> shift) - 32
+
+    @staticmethod
+    def _upper(index: int) -> int:
+        """Largest value, in microseconds, that lands in a slot"""
+        if index < 64:
+            return index
+        shift = (index - 64) // 32 + 1
+        top = (index - 64) % 32 + 32
+        return ((top + 1) << shift) - 1
+
+    def record(self, seconds: float) -> None:
+        index = min(self._index(max(int(seconds * 1e6), 0)), self.SLOTS - 1)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Value in seconds that fraction of the recorded values are at or below"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = max(math.ceil(fraction * self.count), 1)
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank:
+                    return min(self._upper(index) / 1e6, self.max)
+            return self.max
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+# -----------------------------
+# Registry
+# -----------------------------
+
+# Help text of the metrics EnhancedNPCSystem records; names get the registry prefix
+METRIC_HELP = {
+    'llm_seconds': "Model calls, including the LangChain chain around them",
+    'mood_seconds': "Mood classification of a player message",
+    'prompt_seconds': "Choosing and rendering the NPC prompt",
+    'summarize_seconds': "Background memory summarization jobs",
+    'log_write_seconds': "Handing a result to the log writer",
+    'errors_total': "Exceptions while generating a reply, by type",
+    'fallbacks_total': "Replies replaced by the 'seems distracted' fallback",
+    'cache_hits_total': "Replies served from a response cache, by cache",
+    'cache_misses_total': "Response cache lookups that missed, by cache",
+    'llm_tokens_total': "Tokens reported by the model, by kind",
+}
+
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _label_text(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Counters and latency histograms, rendered in the Prometheus text format.
+
+    Metrics are created on first use. Histograms are exported as summaries
+    (quantiles, _sum, _count) plus a _max gauge. Collectors are callables
+    returning {name: value}; they are read at render time, which is how
+    the stats() of the log writer and other components are exposed as
+    gauges without extra bookkeeping on the hot path. A collector name may
+    carry labels, e.g. 'lane_queue_depth{lane="0"}'.
+    """
+
+    enabled = True
+
+    def __init__(self, prefix: str = "npc_"):
+        self.prefix = prefix
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Counter] = {}
+        self._collectors: List[Callable[[], Dict[str, float]]] = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str) -> LatencyHistogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histogram(name).record(seconds)
+
+    def inc(self, name: str, amount: int = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        counter.inc(amount)
+
+    def add_collector(self, collector: Callable[[], Dict[str, float]]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name, histogram in histograms:
+            full = self.prefix + name
+            if name in METRIC_HELP:
+                lines.append(f"# HELP {full} {METRIC_HELP[name]}")
+            lines.append(f"# TYPE {full} summary")
+            for quantile in SUMMARY_QUANTILES:
+                lines.append(f'{full}{{quantile="{quantile}"}} {histogram.percentile(quantile):.6f}')
+            lines.append(f"{full}_sum {histogram.total:.6f}")
+            lines.append(f"{full}_count {histogram.count}")
+            lines.append(f"# TYPE {full}_max gauge")
+            lines.append(f"{full}_max {histogram.max:.6f}")
+        previous = None
+        for (name, labels), counter in counters:
+            full = self.prefix + name
+            if name != previous:
+                if name in METRIC_HELP:
+                    lines.append(f"# HELP {full} {METRIC_HELP[name]}")
+                lines.append(f"# TYPE {full} counter")
+                previous = name
+            lines.append(f"{full}{_label_text(labels)} {counter.value}")
+        for collector in self._collectors:
+            previous = None
+            for name, value in sorted(collector().items()):
+                base = name.split("{", 1)[0]
+                if base != previous:
+                    lines.append(f"# TYPE {self.prefix + base} gauge")
+                    previous = base
+                lines.append(f"{self.prefix + name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Histogram percentiles in milliseconds and counter values, for end-of-run reports"""
+        with self._lock:
+            histograms = dict(self._histograms)
+            counters = dict(self._counters)
+        report: Dict[str, Any] = {}
+        for name, histogram in histograms.items():
+            report[name] = {'count': histogram.count,
+                            'p50_ms': round(histogram.percentile(0.5) * 1000, 3),
+                            'p99_ms': round(histogram.percentile(0.99) * 1000, 3),
+                            'max_ms': round(histogram.max * 1000, 3)}
+        for (name, labels), counter in counters.items():
+            report[name + _label_text(labels)] = counter.value
+        return report
+
+
+class NullMetrics:
+    """Stand-in when metrics are off: every call is a no-op"""
+
+    enabled = False
+
+    def observe(self, name: str, seconds: float) -> None:
+        pass
+
+    def inc(self, name: str, amount: int = 1, **labels) -> None:
+        pass
+
+    def add_collector(self, collector: Callable[[], Dict[str, float]]) -> None:
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Counts the tokens each LangChain model call reports into llm_tokens_total"""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    self.metrics.inc("llm_tokens_total", usage.get('input_tokens', 0), kind="prompt")
+                    self.metrics.inc("llm_tokens_total", usage.get('output_tokens', 0), kind="completion")
+
+
+# -----------------------------
+# Exposition
+# -----------------------------
+
+class MetricsServer:
+    """Serves GET /metrics in the Prometheus text format from a background thread"""
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9100):
+        self.metrics = metrics
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="npc-metrics", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self) -> "MetricsServer":
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._httpd.shutdown()
+        self._thread.join()
+        self._httpd.server_close()
+
+    def _make_handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class MetricsDumper:
+    """Rewrites a file with the rendered metrics every interval seconds, and once more on close.
+
+    The file is replaced atomically, so node_exporter's textfile collector
+    or a tail -f never sees a half-written dump.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.dumps = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="npc-metrics-dump", daemon=True)
+
+    def start(self) -> "MetricsDumper":
+        self._thread.start()
+        return self
+
+    def dump(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp_path, self.path)
+        self.dumps += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.dump()
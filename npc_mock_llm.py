@@ -0,0 +1,328 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions with canned NPC-style replies after a
+simulated delay (time to first token from a latency distribution, plus
+completion tokens at a fixed throughput), fails a configurable share of
+requests, and counts what it served. Nothing leaves the machine, so load
+tests cost nothing and behave the same in CI.
+
+Usage: python npc_mock_llm.py [--port 8000] [--latency-ms 300] [--latency-dist lognormal]
+       [--error-rate 0.01] [--tokens-per-second 50]
+then point a runner at it with --base-url http://127.0.0.1:8000/v1
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+
+from npc_tokens import HeuristicTokenizer
+
+
+# -----------------------------
+# Canned replies
+# -----------------------------
+
+MOCK_REPLIES: Dict[str, List[str]] = {
+    "neutral": [
+        "Aye, the blacksmith is past the fountain. Mind the cart ruts.",
+        "The inn has rooms, if you have the coin.",
+        "Can't say I know much about that, traveler.",
+    ],
+    "friendly": [
+        "Well met, friend! The tavern stew is fresh today, you should try it.",
+        "Welcome to the village! Ask around the market, folks here are kind.",
+        "Ha! Good to see a cheerful face. What brings you our way?",
+    ],
+    "helpful": [
+        "Follow the east road to the old mill, then take the forest path. Bring a torch.",
+        "The temple healers sell potions at a fair price; buy two before you head to the ruins.",
+        "Talk to the guard captain at the barracks, he pays well for wolf pelts.",
+    ],
+    "angry": [
+        "What now? The inn is that way. Leave me be.",
+        "I've no time for fools. Go bother the merchant.",
+        "*grumbles* Fine. The smithy. Past the well. Happy?",
+    ],
+    "confused": [
+        "The ruins, you say? Or was it the mill? Explain it again, slowly.",
+        "I'm not sure I follow, adventurer. Which road do you mean?",
+        "Hmm? A quest about... what exactly?",
+    ],
+}
+
+# npc_chat.py puts "Current Emotional State: x" in the turn message, npc_chat_v1 "Current mood: x"
+_MOOD_PATTERN = re.compile(r"Current (?:Emotional State|mood): (\w+)")
+
+
+def mock_reply(messages: List[Dict[str, Any]], seed: int = 0) -> str:
+    """A reply in the mood named by the prompt, picked deterministically from the last message"""
+    mood = "neutral"
+    for message in reversed(messages):
+        match = _MOOD_PATTERN.search(str(message.get('content') or ""))
+        if match and match.group(1) in MOCK_REPLIES:
+            mood = match.group(1)
+            break
+    last = str(messages[-1].get('content') or "") if messages else ""
+    replies = MOCK_REPLIES[mood]
+    return replies[zlib.crc32(last.encode("utf-8"), seed) % len(replies)]
+
+
+# -----------------------------
+# Latency model
+# -----------------------------
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+class LatencyModel:
+    """Time to first token in seconds.
+
+    fixed: always latency_ms. uniform: latency_ms * (1 ± spread).
+    lognormal: median latency_ms with log-space sigma spread, the long
+    right tail real model APIs show.
+    """
+
+    def __init__(self, latency_ms: float = 300.0, distribution: str = "lognormal", spread: float = 0.5,
+                 seed: Optional[int] = None):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency_ms = latency_ms
+        self.distribution = distribution
+        self.spread = spread
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self._lock:
+            if self.distribution == "uniform":
+                factor = self._rng.uniform(1 - self.spread, 1 + self.spread)
+            elif self.distribution == "lognormal":
+                factor = math.exp(self._rng.gauss(0.0, self.spread))
+            else:
+                factor = 1.0
+        return max(self.latency_ms * factor, 0.0) / 1000
+
+
+# -----------------------------
+# Server
+# -----------------------------
+
+class MockLLMServer:
+    """OpenAI-compatible chat completions server running on a background thread.
+
+    Use url as the client's base_url. A failed request gets a 500 with an
+    OpenAI-style error body; note the OpenAI client retries those (twice by
+    default), so fewer failures reach the caller than error_rate suggests.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 300.0,
+                 latency_dist: str = "lognormal", latency_spread: float = 0.5, error_rate: float = 0.0,
+                 tokens_per_second: Optional[float] = 50.0, seed: int = 0):
+        self.latency = LatencyModel(latency_ms, latency_dist, latency_spread, seed=seed)
+        self.error_rate = error_rate
+        self.tokens_per_second = tokens_per_second
+        self.seed = seed
+        self.tokenizer = HeuristicTokenizer()
+        self._errors_rng = random.Random(seed + 1)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.delay_seconds = 0.0
+        self.max_delay_seconds = 0.0
+
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="mock-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Serve on the calling thread, for the standalone server"""
+        self._httpd.serve_forever()
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def complete(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Chat completion body for a request, after the simulated delay; None for an injected failure"""
+        messages = request.get('messages') or []
+        with self._lock:
+            self.requests += 1
+            request_id = self.requests
+            failed = self._errors_rng.random() < self.error_rate
+        delay = self.latency.sample()
+        if failed:
+            time.sleep(delay)
+            with self._lock:
+                self.errors += 1
+            return None
+
+        reply = mock_reply(messages, self.seed)
+        prompt_tokens = sum(self.tokenizer.count(str(m.get('content') or "")) + 4 for m in messages)
+        completion_tokens = self.tokenizer.count(reply)
+        if self.tokens_per_second:
+            delay += completion_tokens / self.tokens_per_second
+        time.sleep(delay)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.delay_seconds += delay
+            self.max_delay_seconds = max(self.max_delay_seconds, delay)
+        return {
+            'id': f"chatcmpl-mock-{request_id}",
+            'object': "chat.completion",
+            'created': int(time.time()),
+            'model': request.get('model', "mock"),
+            'choices': [{
+                'index': 0,
+                'message': {'role': "assistant", 'content': reply},
+                'finish_reason': "stop",
+                'logprobs': None,
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so clients reuse connections like they would with the real API
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status: int, body: Dict[str, Any]):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _error(self, status: int, message: str, error_type: str):
+                self._send(status, {'error': {'message': message, 'type': error_type, 'param': None, 'code': None}})
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/v1/models":
+                    self._send(200, {'object': "list", 'data': [{'id': "mock", 'object': "model",
+                                                                 'owned_by': "npc_mock_llm"}]})
+                else:
+                    self._error(404, f"No route {self.path}", "invalid_request_error")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self._error(400, "Request body is not JSON", "invalid_request_error")
+                    return
+                if self.path.rstrip("/") != "/v1/chat/completions":
+                    self._error(404, f"No route {self.path}", "invalid_request_error")
+                elif request.get('stream'):
+                    self._error(400, "The mock server does not stream", "invalid_request_error")
+                else:
+                    body = server.complete(request)
+                    if body is None:
+                        self._error(500, "Injected mock failure", "server_error")
+                    else:
+                        self._send(200, body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.requests - self.errors
+        return {
+            'url': self.url,
+            'requests': self.requests,
+            'errors': self.errors,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'mean_delay_ms': round(self.delay_seconds / served * 1000, 1) if served else 0.0,
+            'max_delay_ms': round(self.max_delay_seconds * 1000, 1),
+        }
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser, prefix: str = "") -> None:
+    """Options of MockLLMServer, as --latency-ms etc. or --<prefix>latency-ms"""
+    parser.add_argument(f"--{prefix}latency-ms", type=float, default=300.0,
+                        help="Median time to first token of the mock model, in milliseconds")
+    parser.add_argument(f"--{prefix}latency-dist", choices=LATENCY_DISTRIBUTIONS, default="lognormal",
+                        help="Shape of the mock latency distribution")
+    parser.add_argument(f"--{prefix}latency-spread", type=float, default=0.5,
+                        help="Relative spread (uniform) or log-space sigma (lognormal) of the mock latency")
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=0.0,
+                        help="Share of mock requests answered with a 500 error")
+    parser.add_argument(f"--{prefix}tokens-per-second", type=float, default=50.0,
+                        help="Mock completion throughput; 0 returns the whole reply after the first-token delay")
+    parser.add_argument(f"--{prefix}seed", type=int, default=0, help="Seed for mock latency, failures and replies")
+
+
+def mock_options(args: argparse.Namespace, prefix: str = "") -> Dict[str, Any]:
+    """MockLLMServer keyword arguments from options added by add_mock_arguments"""
+    prefix = prefix.replace("-", "_")
+    return {
+        'latency_ms': getattr(args, f"{prefix}latency_ms"),
+        'latency_dist': getattr(args, f"{prefix}latency_dist"),
+        'latency_spread': getattr(args, f"{prefix}latency_spread"),
+        'error_rate': getattr(args, f"{prefix}error_rate"),
+        'tokens_per_second': getattr(args, f"{prefix}tokens_per_second"),
+        'seed': getattr(args, f"{prefix}seed"),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = MockLLMServer(args.host, args.port, **mock_options(args))
+    print(f"Mock LLM listening on {server.url} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        stats = server.stats()
+        print(f"Served {stats['requests']} requests ({stats['errors']} failed), "
+              f"{stats['prompt_tokens']} prompt / {stats['completion_tokens']} completion tokens, "
+              f"delay mean {stats['mean_delay_ms']}ms / max {stats['max_delay_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
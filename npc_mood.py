@@ -0,0 +1,116 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# -----------------------------
+# Mood trigger rules
+# -----------------------------
+
+class MoodRule:
+    """Trigger words or phrases that push an NPC towards one mood.
+
+    Triggers match whole words only ("hi" does not match "this"). A trailing
+    '*' makes a prefix trigger ("thank*" matches thank, thanks, thankful) and
+    multi-word triggers ("thank you") match consecutive words. When several
+    moods match, the highest priority wins and ties go to the larger summed
+    weight of matched triggers.
+    """
+    __slots__ = ("mood", "triggers", "priority", "weight")
+
+    def __init__(self, mood: str, triggers: Iterable[str], priority: int = 0, weight: float = 1.0):
+        self.mood = mood
+        self.triggers = list(triggers)
+        self.priority = priority
+        self.weight = weight
+
+
+# Apostrophes split words, so "what" also matches "what's"
+_WORD = re.compile(r"[a-z0-9]+")
+
+def tokenize(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+# -----------------------------
+# Classifier
+# -----------------------------
+
+class MoodClassifier:
+    """Classifies messages against all trigger lists at once.
+
+    The rules are compiled into hash tables keyed on word n-grams and word
+    prefixes, so a message costs a few dict lookups per word no matter how
+    many triggers there are, instead of one substring scan per trigger.
+    """
+
+    def __init__(self, rules: List[MoodRule]):
+        self.rules = rules
+        # word tuple -> [(rule index, weight)]
+        self._phrases: Dict[Tuple[str, ...], List[Tuple[int, float]]] = defaultdict(list)
+        # word prefix -> [(rule index, weight)]
+        self._prefixes: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+
+        for index, rule in enumerate(rules):
+            for trigger in rule.triggers:
+                if trigger.endswith("*"):
+                    words = tokenize(trigger[:-1])
+                    if len(words) != 1:
+                        raise ValueError(f"Prefix triggers must be a single word: {trigger!r}")
+                    self._prefixes[words[0]].append((index, rule.weight))
+                else:
+                    words = tuple(tokenize(trigger))
+                    if not words:
+                        raise ValueError(f"Empty mood trigger in rule '{rule.mood}'")
+                    self._phrases[words].append((index, rule.weight))
+
+        self._max_phrase_words = max((len(words) for words in self._phrases), default=0)
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefixes})
+        self._phrases = dict(self._phrases)
+        self._prefixes = dict(self._prefixes)
+
+    def _rule_scores(self, words: List[str]) -> Dict[int, float]:
+        scores: Dict[int, float] = {}
+        phrases = self._phrases
+        prefixes = self._prefixes
+        max_words = self._max_phrase_words
+        count = len(words)
+
+        for i, word in enumerate(words):
+            matches = phrases.get((word,))
+            if matches:
+                for index, weight in matches:
+                    scores[index] = scores.get(index, 0.0) + weight
+            for n in range(2, min(max_words, count - i) + 1):
+                matches = phrases.get(tuple(words[i:i + n]))
+                if matches:
+                    for index, weight in matches:
+                        scores[index] = scores.get(index, 0.0) + weight
+            for length in self._prefix_lengths:
+                if length > len(word):
+                    break
+                matches = prefixes.get(word[:length])
+                if matches:
+                    for index, weight in matches:
+                        scores[index] = scores.get(index, 0.0) + weight
+        return scores
+
+    def scores(self, text: str) -> Dict[str, float]:
+        """Summed trigger weight per mood for one message"""
+        totals: Dict[str, float] = {}
+        for index, score in self._rule_scores(tokenize(text)).items():
+            mood = self.rules[index].mood
+            totals[mood] = totals.get(mood, 0.0) + score
+        return totals
+
+    def classify(self, text: str) -> Optional[str]:
+        """Winning mood for a message, or None when no trigger matches"""
+        scores = self._rule_scores(tokenize(text))
+        if not scores:
+            return None
+        best = max(scores, key=lambda index: (self.rules[index].priority, scores[index], -index))
+        return self.rules[best].mood
+
+    def classify_batch(self, texts: Iterable[str]) -> List[Optional[str]]:
+        """Classify many messages in one pass over the batch"""
+        return [self.classify(text) for text in texts]
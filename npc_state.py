@@ -0,0 +1,116 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional
+
+
+# -----------------------------
+# Cold player state
+# -----------------------------
+
+class SQLitePlayerStore:
+    """Serialized state of players whose chains were evicted from memory.
+
+    Rows are the JSON produced by EnhancedNPCSystem.export_player_state, so
+    an idle player costs a row on disk instead of a live ConversationChain.
+    A row is removed when its player is rehydrated with pop(), so the store
+    only ever holds players that are not in memory.
+    Reads and writes are timed; rehydration latency is what a player waits
+    for on their first message after being evicted.
+    """
+
+    def __init__(self, path: str = "logs/player_state.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS players ("
+            " player_id INTEGER PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM players").fetchone()[0]
+
+        self.reads = 0
+        self.read_misses = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.read_seconds = 0.0
+        self.max_read_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def get(self, player_id: int) -> Optional[Dict[str, Any]]:
+        started = time.perf_counter()
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM players WHERE player_id = ?", (player_id,)).fetchone()
+            if row is None:
+                self.read_misses += 1
+                return None
+            data = json.loads(row[0])
+            elapsed = time.perf_counter() - started
+            self.reads += 1
+            self.read_seconds += elapsed
+            self.max_read_seconds = max(self.max_read_seconds, elapsed)
+            return data
+
+    def pop(self, player_id: int) -> Optional[Dict[str, Any]]:
+        """get() for a player being rehydrated: the row is deleted, the player lives in memory again"""
+        data = self.get(player_id)
+        if data is not None:
+            with self._lock:
+                self._conn.execute("DELETE FROM players WHERE player_id = ?", (player_id,))
+                self._conn.commit()
+                self._size -= 1
+        return data
+
+    def __contains__(self, player_id: int) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM players WHERE player_id = ?", (player_id,)).fetchone() is not None
+
+    def put(self, player_id: int, data: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        encoded = json.dumps(data)
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM players WHERE player_id = ?", (player_id,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO players (player_id, state, updated_at) VALUES (?, ?, ?)",
+                (player_id, encoded, time.time())
+            )
+            self._conn.commit()
+            if not exists:
+                self._size += 1
+            self.writes += 1
+            self.bytes_written += len(encoded)
+            self.write_seconds += time.perf_counter() - started
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM players")
+            self._conn.commit()
+            self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'cold_players': self._size,
+            'reads': self.reads,
+            'read_misses': self.read_misses,
+            'writes': self.writes,
+            'bytes_written': self.bytes_written,
+            'mean_read_ms': round(self.read_seconds / self.reads * 1000, 3) if self.reads else 0.0,
+            'max_read_ms': round(self.max_read_seconds * 1000, 3),
+            'mean_write_ms': round(self.write_seconds / self.writes * 1000, 3) if self.writes else 0.0,
+        }
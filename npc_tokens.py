@@ -0,0 +1,231 @@
+import os
+import re
+import threading
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+try:
+    import tiktoken
+    from tiktoken.load import load_tiktoken_bpe
+except ImportError:  # HeuristicTokenizer is used instead
+    tiktoken = None
+
+
+# -----------------------------
+# Tokenizers
+# -----------------------------
+
+# Pre-tokenization pattern and special tokens of cl100k_base (gpt-3.5-turbo / gpt-4)
+_CL100K_PATTERN = (r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+"""
+                   r"""|\s++$|\s*[\r\n]|\s+(?!\S)|\s""")
+_CL100K_SPECIAL = {"<|endoftext|>": 100257, "<|fim_prefix|>": 100258, "<|fim_middle|>": 100259,
+                   "<|fim_suffix|>": 100260, "<|endofprompt|>": 100276}
+
+
+class HeuristicTokenizer:
+    """BPE-like estimate used when no vocabulary is available offline.
+
+    Words count as one token per started 4 characters, and each punctuation
+    mark as one token. That is within ~10% of cl100k_base on English chat
+    text, which is enough to keep prompts inside a budget.
+    """
+
+    name = "heuristic"
+    _PIECES = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+
+    def count(self, text: str) -> int:
+        return sum((len(piece) + 3) // 4 for piece in self._PIECES.findall(text))
+
+
+class TiktokenTokenizer:
+    """Exact counts from a tiktoken encoding"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = encoding.name
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def load_tokenizer(vocab_path: Optional[str] = None, encoding_name: str = "cl100k_base"):
+    """Best tokenizer available.
+
+    Tries a local cl100k-style .tiktoken vocabulary (vocab_path or the
+    NPC_TOKENIZER_VOCAB environment variable), then tiktoken's encoding,
+    and falls back to HeuristicTokenizer. tiktoken downloads the encoding
+    when it is not in its cache, so without a vocab_path this can reach
+    the network; it falls back silently when there is none.
+    """
+    vocab_path = vocab_path or os.getenv("NPC_TOKENIZER_VOCAB")
+    if tiktoken is not None:
+        if vocab_path:
+            encoding = tiktoken.Encoding(name=os.path.basename(vocab_path), pat_str=_CL100K_PATTERN,
+                                         mergeable_ranks=load_tiktoken_bpe(vocab_path),
+                                         special_tokens=_CL100K_SPECIAL)
+            return TiktokenTokenizer(encoding)
+        try:
+            return TiktokenTokenizer(tiktoken.get_encoding(encoding_name))
+        except Exception:  # not cached and no network
+            pass
+    elif vocab_path:
+        raise ImportError("A tokenizer vocabulary needs tiktoken (pip install tiktoken)")
+    return HeuristicTokenizer()
+
+
+# -----------------------------
+# Cached counting
+# -----------------------------
+
+class TokenCounter:
+    """Token counts per text, computed once.
+
+    Chat turns are counted again and again as history is re-packed for
+    every new message; this keeps the count of each distinct text so the
+    tokenizer only runs on new ones. The cache is cleared wholesale when it
+    reaches max_entries, which is cheaper than LRU bookkeeping per lookup.
+    """
+
+    # Role and separator tokens the chat format adds around each message
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, tokenizer=None, max_entries: int = 200000):
+        self.tokenizer = tokenizer or load_tokenizer()
+        self.max_entries = max_entries
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, text: str) -> int:
+        tokens = self._counts.get(text)
+        if tokens is not None:
+            self.hits += 1
+            return tokens
+        tokens = self.tokenizer.count(text)
+        with self._lock:
+            if len(self._counts) >= self.max_entries:
+                self._counts.clear()
+            self._counts[text] = tokens
+            self.misses += 1
+        return tokens
+
+    def count_message(self, text: str) -> int:
+        return self.count(text) + self.MESSAGE_OVERHEAD
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'tokenizer': self.tokenizer.name,
+            'cached_texts': len(self._counts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def pack_turns(turn_tokens: Sequence[int], budget: int) -> int:
+    """How many of the newest turns fit in budget tokens (turn_tokens is oldest first).
+
+    Turns are taken newest first and packing stops at the first one that
+    doesn't fit, so the history never has gaps.
+    """
+    used = 0
+    taken = 0
+    for tokens in reversed(turn_tokens):
+        if used + tokens > budget:
+            break
+        used += tokens
+        taken += 1
+    return taken
+
+
+class ContextBudget:
+    """Splits a prompt token budget between the fixed prompt, the new message and history"""
+
+    def __init__(self, counter: TokenCounter, prompt_tokens: int = 1500):
+        self.counter = counter
+        self.prompt_tokens = prompt_tokens
+        self.packed = 0
+        self.turns_offered = 0
+        self.turns_packed = 0
+        self.over_budget = 0
+
+    def history_budget(self, fixed_text_tokens: int, message: str) -> int:
+        """Tokens left for history once the fixed prompt and the player message are in"""
+        return self.prompt_tokens - fixed_text_tokens - self.counter.count_message(message)
+
+    def select(self, turns: List[Tuple[str, str]], budget: int) -> List[Tuple[str, str]]:
+        """Newest (player, npc) turns that fit in budget tokens"""
+        counter = self.counter
+        costs = [counter.count_message(player) + counter.count_message(npc) for player, npc in turns]
+        taken = pack_turns(costs, max(budget, 0))
+        self.packed += 1
+        self.turns_offered += len(turns)
+        self.turns_packed += taken
+        if budget < 0:
+            self.over_budget += 1
+        return list(turns[len(turns) - taken:])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'packs': self.packed,
+            'turns_offered': self.turns_offered,
+            'turns_packed': self.turns_packed,
+            'over_budget': self.over_budget,
+        }
+
+
+# -----------------------------
+# Prompt prefix reuse
+# -----------------------------
+
+class PrefixReuseTracker:
+    """How much of the prompt traffic starts with a system prefix that was already sent.
+
+    Providers cache the longest prompt prefix they have seen recently and
+    skip re-processing it (OpenAI: prompts of at least 1024 tokens, cached
+    in 128-token steps, billed at a discount). Each call records its
+    system prefix; a prefix seen earlier in the run counts as reused and
+    its cacheable tokens as saved. It is an estimate: provider caches also
+    expire after a few idle minutes, which this does not model.
+    """
+
+    def __init__(self, counter: TokenCounter, min_tokens: int = 1024, block_tokens: int = 128):
+        self.counter = counter
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self._seen: set = set()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.reused = 0
+        self.prefix_tokens = 0
+        self.tokens_saved = 0
+
+    def cacheable_tokens(self, tokens: int) -> int:
+        if tokens < self.min_tokens:
+            return 0
+        return tokens // self.block_tokens * self.block_tokens
+
+    def record(self, prefix: str) -> None:
+        # The same prefix object comes back every call, so hashing and counting are cached
+        tokens = self.counter.count_message(prefix)
+        with self._lock:
+            self.calls += 1
+            self.prefix_tokens += tokens
+            if prefix in self._seen:
+                self.reused += 1
+                self.tokens_saved += self.cacheable_tokens(tokens)
+            else:
+                self._seen.add(prefix)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'distinct_prefixes': len(self._seen),
+            'reused': self.reused,
+            'reuse_ratio': round(self.reused / self.calls, 4) if self.calls else 0.0,
+            'prefix_tokens': self.prefix_tokens,
+            'tokens_saved': self.tokens_saved,
+            'saved_ratio': round(self.tokens_saved / self.prefix_tokens, 4) if self.prefix_tokens else 0.0,
+        }
@@ -0,0 +1,258 @@
+import json
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# -----------------------------
+# Spans
+# -----------------------------
+
+class Span:
+    """One timed operation of a trace; a context manager that makes itself the current span.
+
+    Spans of a trace are collected on the trace and handed to the exporter
+    together when the root span ends, so a trace is written as one batch
+    of lines and a partially finished trace is never exported.
+    """
+
+    __slots__ = ("tracer", "name", "trace", "span_id", "parent_id", "attributes", "start_time", "duration",
+                 "error", "_started", "_token")
+
+    def __init__(self, tracer: "Tracer", name: str, trace: "_Trace", parent_id: Optional[str],
+                 attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.trace = trace
+        self.span_id = tracer._new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = 0.0
+        self.duration = 0.0
+        self.error = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount: int) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def __enter__(self) -> "Span":
+        self._token = self.tracer._current.set(self)
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.duration = time.perf_counter() - self._started
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.tracer._current.reset(self._token)
+        self.trace.spans.append(self)
+        if self.parent_id is None:
+            self.tracer._export(self.trace)
+        return False
+
+    def to_record(self) -> Dict[str, Any]:
+        record = {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_time': round(self.start_time, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+        }
+        if self.error is not None:
+            record['error'] = self.error
+        return record
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List[Span] = []
+
+
+class NoopSpan:
+    """Span of an unsampled trace, or of NullTracer: every call is a no-op"""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def add(self, key: str, amount: int) -> None:
+        pass
+
+    def __enter__(self) -> "NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class _UnsampledRoot:
+    """Root of a trace that was not sampled; its children see NOOP_SPAN and record nothing"""
+
+    __slots__ = ("_current", "_token")
+
+    def __init__(self, current: ContextVar):
+        self._current = current
+
+    def __enter__(self) -> NoopSpan:
+        self._token = self._current.set(NOOP_SPAN)
+        return NOOP_SPAN
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._current.reset(self._token)
+        return False
+
+
+# -----------------------------
+# Tracers
+# -----------------------------
+
+class Tracer:
+    """Traces made of nested spans, with the current span kept in a contextvar.
+
+    The first span opened with no current span is a root and starts a
+    trace; whether the trace is recorded is decided there, once, with
+    probability sample_rate. The contextvar follows asyncio tasks and is
+    per thread, so concurrent messages in async and lanes mode each get
+    their own trace.
+    """
+
+    enabled = True
+
+    def __init__(self, exporter: "JsonlSpanExporter", sample_rate: float = 1.0, seed: Optional[int] = None):
+        if not 0.0 <= sample_rate <= 1.0:
+            raise ValueError(f"Sample rate must be between 0 and 1, got {sample_rate}")
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self._rng = random.Random(seed)
+        self._current: ContextVar[Optional[Any]] = ContextVar(f"npc_span_{id(self)}", default=None)
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.sampled = 0
+
+    def _new_id(self) -> str:
+        return f"{self._rng.getrandbits(64):016x}"
+
+    def span(self, name: str, **attributes):
+        """Context manager for a span named name, a child of the current span if there is one"""
+        parent = self._current.get()
+        if parent is NOOP_SPAN:
+            return NOOP_SPAN
+        if parent is None:
+            with self._lock:
+                self.traces += 1
+                if self._rng.random() >= self.sample_rate:
+                    return _UnsampledRoot(self._current)
+                self.sampled += 1
+            return Span(self, name, _Trace(self._new_id() + self._new_id()), None, attributes)
+        return Span(self, name, parent.trace, parent.span_id, attributes)
+
+    def current_span(self):
+        """The span code is running in, NOOP_SPAN in an unsampled trace, or None outside any trace"""
+        return self._current.get()
+
+    def set_attributes(self, **attributes) -> None:
+        span = self._current.get()
+        if span is not None:
+            span.set(**attributes)
+
+    def _export(self, trace: _Trace) -> None:
+        self.exporter.export(trace.spans)
+
+    def close(self) -> None:
+        self.exporter.close()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {'traces': self.traces, 'sampled': self.sampled, 'sample_rate': self.sample_rate}
+        stats.update(self.exporter.stats())
+        return stats
+
+
+class NullTracer:
+    """Stand-in when tracing is off: every span is NOOP_SPAN"""
+
+    enabled = False
+
+    def span(self, name: str, **attributes) -> NoopSpan:
+        return NOOP_SPAN
+
+    def current_span(self):
+        return None
+
+    def set_attributes(self, **attributes) -> None:
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class TraceTokensCallback(BaseCallbackHandler):
+    """Adds the tokens each LangChain model call reports to the current span"""
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        span = self.tracer.current_span()
+        if span is None:
+            return
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    span.add("prompt_tokens", usage.get('input_tokens', 0))
+                    span.add("completion_tokens", usage.get('output_tokens', 0))
+
+
+# -----------------------------
+# Export
+# -----------------------------
+
+class JsonlSpanExporter:
+    """Appends finished traces to a JSONL file, one span per line, spans of a trace in start order.
+
+    Writes go through the file's buffer under a lock; nothing is sent
+    anywhere, so no collector is needed. Load the file with pandas or
+    jq, or convert it for a trace viewer.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.spans = 0
+        self.bytes_written = 0
+
+    def export(self, spans: List[Span]) -> None:
+        spans = sorted(spans, key=lambda span: span.start_time)
+        data = "".join(json.dumps(span.to_record(), separators=(",", ":")) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(data)
+            self.traces += 1
+            self.spans += len(spans)
+            self.bytes_written += len(data)
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'path': self.path, 'exported_traces': self.traces, 'exported_spans': self.spans,
+                'bytes_written': self.bytes_written}
@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from npc_checkpoint import CheckpointStore
+
+
+def state(cursor: int) -> dict:
+    return {'npc_key': "merchant", 'mood': "neutral", 'turns': cursor, 'summary': "", 'messages': []}
+
+
+def test_resume_after_torn_journal_line_keeps_later_saves(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    store = CheckpointStore(path, compact_every=3)
+    store.save(10, 100, {1: state(10)})
+    store.close()
+    # Crash in the middle of the next save
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"player": 2, "state": {"npc_k')
+
+    resumed = CheckpointStore(path, compact_every=3)
+    checkpoint = resumed.load()
+    assert checkpoint['cursor'] == 10
+    assert checkpoint['players'] == {1: state(10)}
+
+    resumed.save(20, 200, {1: state(20), 2: state(20)})
+    resumed.save(30, 300, {3: state(30)})
+    resumed.save(40, 400, {1: state(40)})  # third save since the resume: compacts
+    assert resumed.compactions == 1
+    resumed.save(50, 500, {2: state(50)})
+    resumed.close()
+
+    checkpoint = CheckpointStore(path).load()
+    assert checkpoint['cursor'] == 50
+    assert checkpoint['log_offset'] == 500
+    assert checkpoint['players'] == {1: state(40), 2: state(50), 3: state(30)}
+
+
+def test_uncommitted_players_of_a_torn_save_are_dropped(tmp_path):
+    path = str(tmp_path / "run.ckpt")
+    store = CheckpointStore(path)
+    store.save(10, 100, {1: state(10)})
+    store.close()
+    # A complete player line whose save never got its cursor line
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"player": 2, "state": {}}\n')
+
+    resumed = CheckpointStore(path)
+    resumed.save(20, 200, {1: state(20)})
+    resumed.close()
+
+    assert CheckpointStore(path).load()['players'] == {1: state(20)}